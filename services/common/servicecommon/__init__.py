@@ -0,0 +1,3 @@
+# Job infrastructure shared by the web, kaldi-serve and finnish-forced-align
+# services. Each image copies this package next to its own code, with the
+# services directory as the build context, see docker-compose.yml.
@@ -0,0 +1,84 @@
+import os
+import time
+import threading
+import redis
+
+# When a job's final status is written, it's published on "job:<jobid>", so
+# that query_job requests with a wait parameter can block until then instead
+# of the client polling.
+
+MAX_WAIT = 30.0
+
+# Each waiting request holds one of gunicorn's threads, so only MAX_WAITERS
+# requests per process wait at a time, leaving the rest of the threads for
+# submissions, segments posted back by kaldi-serve and health checks. Further
+# queries are answered at once, and the client polls as without wait.
+MAX_WAITERS = int(os.environ.get("MAX_WAITERS", 4))
+waiters = threading.Semaphore(MAX_WAITERS)
+
+
+def channel(_id):
+    return "job:" + _id
+
+
+def notify(redis_conn, _id, status):
+    redis_conn.publish(channel(_id), status)
+
+
+def finish(redis_conn, _id, mapping):
+    """Set the fields in mapping, including the final status, on the hash of
+    job _id and notify waiters, if the job is still pending. This is atomic,
+    so a job that is cancelled while its result is being committed, or
+    finishes while it's being cancelled, keeps the status it got first.
+    Returns whether the job was pending."""
+    with redis_conn.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(_id)
+                if pipe.hget(_id, "status") != "pending":
+                    return False
+                pipe.multi()
+                pipe.hset(_id, mapping=mapping)
+                pipe.execute()
+                break
+            except redis.WatchError:
+                continue
+    notify(redis_conn, _id, mapping["status"])
+    return True
+
+
+def wait_time(args):
+    """Return the wait query parameter in seconds, clamped to [0, MAX_WAIT]."""
+    try:
+        return min(max(float(args.get("wait", 0)), 0.0), MAX_WAIT)
+    except ValueError:
+        return 0.0
+
+
+def wait_for(redis_conn, _id, is_pending, timeout):
+    """Block until is_pending() is false, or a status change of _id is
+    published, or timeout seconds have passed. Returns at once if
+    MAX_WAITERS requests are already waiting."""
+    if timeout <= 0 or not waiters.acquire(blocking=False):
+        return
+    try:
+        wait(redis_conn, _id, is_pending, time.time() + timeout)
+    finally:
+        waiters.release()
+
+
+def wait(redis_conn, _id, is_pending, deadline):
+    pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel(_id))
+    try:
+        # checked only after subscribing, so a notification can't slip by
+        if not is_pending():
+            return
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            if pubsub.get_message(timeout=remaining) is not None:
+                return
+    finally:
+        pubsub.close()
@@ -0,0 +1,316 @@
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+import redis
+from flask import Response
+
+# In-process metrics, served in the Prometheus text format on /metrics.
+#
+# Stage timings: a job records how many seconds it spent in each stage of its
+# processing in its redis hash, as "timing:<stage>" fields, which query_job
+# returns with timings=true. Every time spent in a stage is also collected
+# into the stage_seconds histogram, whether or not it was for a job.
+
+TIMING_PREFIX = "timing:"
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)
+ROUND_TRIP_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# for real_time_factor, seconds of processing per second of audio
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Return [(upper bound, cumulative count)], the sum and the count."""
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        count = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            count += bucket_count
+            cumulative.append((bound, count))
+        return cumulative, total, count
+
+
+# Metrics by (name, labels), labels being a sorted tuple of (label, value)
+counters = {}
+gauges = {}
+gauge_functions = {}
+histograms = {}
+registry_lock = threading.Lock()
+
+
+def key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """Add amount to a counter."""
+    with registry_lock:
+        counters[key(name, labels)] = counters.get(key(name, labels), 0) + amount
+
+
+def add_gauge(name, amount, **labels):
+    with registry_lock:
+        gauges[key(name, labels)] = gauges.get(key(name, labels), 0) + amount
+
+
+@contextmanager
+def in_progress(name, amount=1, **labels):
+    """Add amount to a gauge for the duration of the block."""
+    add_gauge(name, amount, **labels)
+    try:
+        yield
+    finally:
+        add_gauge(name, -amount, **labels)
+
+
+def gauge_function(name, function, **labels):
+    """Register a gauge whose value is function() at the time of reading."""
+    with registry_lock:
+        gauge_functions[key(name, labels)] = function
+
+
+@contextmanager
+def pending(stage, audio_seconds=0):
+    """Count a job and its audio as pending in stage for the duration of the
+    block."""
+    with in_progress("pending_jobs", stage=stage), in_progress(
+        "pending_audio_seconds", audio_seconds, stage=stage
+    ):
+        yield
+
+
+def histogram(name, buckets=BUCKETS, **labels):
+    with registry_lock:
+        if key(name, labels) not in histograms:
+            histograms[key(name, labels)] = Histogram(buckets)
+        return histograms[key(name, labels)]
+
+
+gauge_function("threads", threading.active_count)
+# see in_progress("subprocesses") in the services
+add_gauge("subprocesses", 0)
+
+
+def observe(stage, seconds):
+    histogram("stage_seconds", stage=stage).observe(seconds)
+
+
+class Timings:
+    """Seconds per stage of one job, summed over calls and threads."""
+
+    def __init__(self):
+        self.seconds = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def fields(self):
+        """Return the timings as job hash fields."""
+        with self.lock:
+            return {
+                TIMING_PREFIX + stage: round(seconds, 3)
+                for stage, seconds in self.seconds.items()
+            }
+
+
+# The Timings of the job the current thread is working on, if any, and the
+# number of redis commands sent for the request it is serving
+local = threading.local()
+
+
+def current():
+    return getattr(local, "timings", None)
+
+
+@contextmanager
+def collecting(timings):
+    previous = current()
+    local.timings = timings
+    try:
+        yield timings
+    finally:
+        local.timings = previous
+
+
+def collects_timings(function):
+    """Decorate function to run with a new Timings of its own."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with collecting(Timings()):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def bind(function):
+    """Return function wrapped to add to the calling thread's Timings,
+    wherever it runs."""
+    timings = current()
+
+    def bound(*args, **kwargs):
+        with collecting(timings):
+            return function(*args, **kwargs)
+
+    return bound
+
+
+def record(stage, seconds):
+    """Observe seconds spent in stage, and add them to the current Timings."""
+    observe(stage, seconds)
+    timings = current()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def stage(name):
+    """Record the time spent in the block as stage name."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start)
+
+
+def fields():
+    """Return the current Timings as job hash fields."""
+    timings = current()
+    if timings is None:
+        return {}
+    return timings.fields()
+
+
+def pop_timings(redis_hash):
+    """Remove the timing fields from a job hash, and return them as
+    {stage: seconds}."""
+    keys = [key for key in redis_hash if key.startswith(TIMING_PREFIX)]
+    return {key[len(TIMING_PREFIX) :]: float(redis_hash.pop(key)) for key in keys}
+
+
+def wants_timings(args):
+    return args.get("timings", "").lower() == "true"
+
+
+class CountingRedis(redis.Redis):
+    """Redis client that counts the commands it sends, in total and for the
+    request being served, see counting_round_trips."""
+
+    def execute_command(self, *args, **options):
+        inc("redis_commands_total")
+        if getattr(local, "round_trips", None) is not None:
+            local.round_trips += 1
+        return super().execute_command(*args, **options)
+
+
+def counting_round_trips(function, route=None):
+    """Decorate a route to observe how many redis commands it sends, labelled
+    with route, by default the function's name."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        local.round_trips = 0
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram(
+                "redis_round_trips_per_query",
+                ROUND_TRIP_BUCKETS,
+                route=route or function.__name__,
+            ).observe(local.round_trips)
+            local.round_trips = None
+
+    return wrapper
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                label, str(value).replace("\\", "\\\\").replace('"', '\\"')
+            )
+            for label, value in labels
+        )
+    )
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return str(value)
+
+
+def render(namespace):
+    """Return all the metrics in the Prometheus text format, with names
+    prefixed by namespace."""
+    with registry_lock:
+        samples = [("counter",) + item for item in counters.items()]
+        samples += [("gauge",) + item for item in gauges.items()]
+        samples += [
+            ("gauge", key, function) for key, function in gauge_functions.items()
+        ]
+        histogram_items = list(histograms.items())
+    families = {}
+    for metric_type, (name, labels), value in samples:
+        if callable(value):
+            value = value()
+        families.setdefault((name, metric_type), []).append(
+            "{}_{}{} {}".format(
+                namespace, name, format_labels(labels), format_value(value)
+            )
+        )
+    for (name, labels), item in histogram_items:
+        buckets, total, count = item.snapshot()
+        lines = families.setdefault((name, "histogram"), [])
+        for bound, bucket_count in buckets:
+            lines.append(
+                "{}_{}_bucket{} {}".format(
+                    namespace,
+                    name,
+                    format_labels(labels + (("le", format_value(bound)),)),
+                    bucket_count,
+                )
+            )
+        for suffix, value in (("sum", total), ("count", count)):
+            lines.append(
+                "{}_{}_{}{} {}".format(
+                    namespace, name, suffix, format_labels(labels), value
+                )
+            )
+    out = []
+    for (name, metric_type), lines in sorted(families.items()):
+        out.append("# TYPE {}_{} {}".format(namespace, name, metric_type))
+        out.extend(sorted(lines) if metric_type != "histogram" else lines)
+    return "\n".join(out) + "\n"
+
+
+def add_route(app, namespace):
+    """Serve the metrics, prefixed by namespace, on /metrics of the Flask
+    app. It's for monitoring from within the cluster, nginx doesn't proxy
+    it."""
+
+    def route_metrics():
+        return Response(render(namespace), mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule("/metrics", "route_metrics", route_metrics, methods=["GET"])
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import zlib
+import logging
+import threading
+from tempfile import NamedTemporaryFile
+
+# Job payloads (results) are kept out of the job hashes, under the key
+# "<jobid>:<field>", as zlib-compressed compact json. Payloads that are still
+# larger than spill_threshold bytes are written to spool_dir, and redis only
+# holds the file name. The sizeable part of a job then survives redis
+# evicting memory, and many more jobs fit under maxmemory.
+#
+# A job with many parts can keep them as items of one redis hash,
+# "<jobid>:<field>", see put_item.
+
+INLINE = b"Z"
+SPILLED = b"F"
+
+
+class PayloadStore:
+    def __init__(self, redis_conn, spool_dir, spill_threshold, expiry_time):
+        # the payloads are binary, so redis_conn must not decode responses
+        self.redis_conn = redis_conn
+        self.spool_dir = spool_dir
+        self.spill_threshold = spill_threshold
+        self.expiry_time = expiry_time
+        self.last_sweep = 0.0
+        self.sweep_lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def key(self, _id, field):
+        return "{}:{}".format(_id, field)
+
+    def path(self, _id, field):
+        return os.path.join(self.spool_dir, self.key(_id, field))
+
+    def encode(self, _id, field, value):
+        """Return value as stored in redis, spilling it to a file if need be."""
+        data = zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"))
+        if len(data) <= self.spill_threshold:
+            return INLINE + data
+        with NamedTemporaryFile(dir=self.spool_dir, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, self.path(_id, field))
+        return SPILLED + self.key(_id, field).encode("utf-8")
+
+    def decode(self, stored):
+        if stored[:1] == SPILLED:
+            try:
+                with open(os.path.join(self.spool_dir, stored[1:].decode("utf-8")), "rb") as f:
+                    data = f.read()
+            except OSError as ex:
+                logging.error("spilled payload missing: " + str(ex))
+                return None
+        else:
+            data = stored[1:]
+        return json.loads(zlib.decompress(data).decode("utf-8"))
+
+    def put(self, _id, field, value):
+        stored = self.encode(_id, field, value)
+        self.redis_conn.set(self.key(_id, field), stored, ex=self.expiry_time)
+        self.sweep()
+
+    def get(self, _id, field):
+        """Return the stored value, or None if there is none."""
+        stored = self.redis_conn.get(self.key(_id, field))
+        if stored is None:
+            return None
+        return self.decode(stored)
+
+    def put_item(self, _id, field, item, value):
+        """Store value as item of the hash "<jobid>:<field>". Adding items
+        doesn't extend the hash's expiry: it expires expiry_time after the
+        first item, unless expire_with_job sets it along with the job's."""
+        stored = self.encode(_id, "{}:{}".format(field, item), value)
+        pipeline = self.redis_conn.pipeline(transaction=False)
+        pipeline.hset(self.key(_id, field), item, stored)
+        pipeline.ttl(self.key(_id, field))
+        if pipeline.execute()[1] < 0:
+            self.redis_conn.expire(self.key(_id, field), self.expiry_time)
+        self.sweep()
+
+    def expire_with_job(self, _id, field):
+        """Have the job hash _id and "<jobid>:<field>" expire expiry_time from
+        now, together."""
+        pipeline = self.redis_conn.pipeline()
+        pipeline.expire(_id, self.expiry_time)
+        pipeline.expire(self.key(_id, field), self.expiry_time)
+        pipeline.execute()
+
+    def get_items(self, _id, field):
+        """Return {item: value} of the hash "<jobid>:<field>", leaving out
+        items whose spilled file is missing."""
+        items = {}
+        for item, stored in self.redis_conn.hgetall(self.key(_id, field)).items():
+            value = self.decode(stored)
+            if value is not None:
+                items[item.decode("utf-8")] = value
+        return items
+
+    def sweep(self):
+        """Delete spilled payloads older than expiry_time, at most once an hour."""
+        with self.sweep_lock:
+            now = time.time()
+            if now - self.last_sweep < 3600:
+                return
+            self.last_sweep = now
+        for filename in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, filename)
+            try:
+                if now - os.path.getmtime(path) > self.expiry_time:
+                    os.remove(path)
+            except OSError:
+                pass
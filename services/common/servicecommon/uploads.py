@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import uuid
+import threading
+
+# Resumable uploads. A client creates an upload, PUTs the file in chunks at
+# increasing offsets, and finally turns the upload into a normal job. Chunks
+# are streamed straight into a file in spool_dir, and if the connection drops,
+# the client asks for the current offset and continues from there.
+
+READ_SIZE = 2 ** 20
+# uploads go to disk, so they can be larger than the request bodies the
+# services take in memory
+MAX_SIZE = 2 * 2 ** 30
+
+
+class UploadError(Exception):
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+
+class UploadSpool:
+    def __init__(self, spool_dir, expiry_time, max_size=MAX_SIZE):
+        self.spool_dir = spool_dir
+        self.expiry_time = expiry_time
+        self.max_size = max_size
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def data_path(self, upload_id):
+        return os.path.join(self.spool_dir, upload_id + ".part")
+
+    def meta_path(self, upload_id):
+        return os.path.join(self.spool_dir, upload_id + ".json")
+
+    def check(self, upload_id):
+        try:
+            uuid.UUID(upload_id)
+        except ValueError:
+            raise UploadError("upload id not available")
+        if not os.path.isfile(self.meta_path(upload_id)):
+            raise UploadError("upload id not available")
+
+    def lock(self, upload_id):
+        with self.locks_lock:
+            return self.locks.setdefault(upload_id, threading.Lock())
+
+    def create(self, file_name):
+        self.sweep()
+        upload_id = str(uuid.uuid4())
+        open(self.data_path(upload_id), "wb").close()
+        with open(self.meta_path(upload_id), "w", encoding="utf-8") as f:
+            json.dump({"file": file_name, "created": round(time.time(), 3)}, f)
+        return upload_id
+
+    def offset(self, upload_id):
+        self.check(upload_id)
+        return os.path.getsize(self.data_path(upload_id))
+
+    def file_name(self, upload_id):
+        self.check(upload_id)
+        with open(self.meta_path(upload_id), encoding="utf-8") as f:
+            return json.load(f)["file"]
+
+    def write(self, upload_id, offset, stream):
+        """Append stream to the upload, which must so far have exactly offset
+        bytes. Return the new offset."""
+        self.check(upload_id)
+        with self.lock(upload_id):
+            received = os.path.getsize(self.data_path(upload_id))
+            if offset != received:
+                raise UploadError("expected offset {}".format(received), received)
+            with open(self.data_path(upload_id), "ab") as f:
+                while True:
+                    block = stream.read(READ_SIZE)
+                    if not block:
+                        break
+                    received += len(block)
+                    if received > self.max_size:
+                        f.truncate(offset)
+                        raise UploadError(
+                            "upload exceeded maximum of {} bytes".format(self.max_size),
+                            offset,
+                        )
+                    f.write(block)
+            return received
+
+    def discard(self, upload_id):
+        with self.locks_lock:
+            self.locks.pop(upload_id, None)
+        for path in (self.data_path(upload_id), self.meta_path(upload_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def sweep(self):
+        """Delete uploads that haven't been written to in expiry_time."""
+        now = time.time()
+        for filename in os.listdir(self.spool_dir):
+            upload_id = filename.rsplit(".", 1)[0]
+            try:
+                if now - os.path.getmtime(self.data_path(upload_id)) > self.expiry_time:
+                    self.discard(upload_id)
+            except OSError:
+                pass
@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-from flask import Flask, request, Response, jsonify
+from flask import Flask, request, jsonify
 import json
 from io import BytesIO
 import sys
@@ -16,8 +16,13 @@ import time
 import platform
 import re
 import os
+import signal
 import shutil
 from tempfile import TemporaryFile
+from servicecommon.payloads import PayloadStore
+from servicecommon import jobwait
+from servicecommon import metrics
+from servicecommon.uploads import UploadSpool, UploadError
 
 MAX_CONTENT_LENGTH = 500*2**20
 
@@ -29,28 +34,71 @@ DATA_DIR_EMPTY = "DATA_DIR_EMPTY"
 DataInDir = '/opt/kaldi/egs/src_for_wav'
 DataOutDir = '/opt/kaldi/egs/kohdistus'
 DataInDirStaging = '/home/app/wav_staging'
+staging_lock = threading.Lock()
+# seconds a submission waits for the staging directory before giving up
+STAGING_LOCK_TIMEOUT = 25
 
-redis_conn = redis.Redis(host='redis', port=6379, decode_responses = True)
+# the job being aligned and the aligner process, for cancelling
+aligning = {'jobid': None, 'process': None}
+aligning_lock = threading.Lock()
+
+redis_conn = metrics.CountingRedis(host='redis', port=6379, decode_responses = True)
 
 expiry_time = 60*60*24*10
 
+uploads = UploadSpool(os.environ.get('UPLOAD_DIR', '/home/app/uploads'),
+                      expiry_time = 60*60*24)
+
+# the aligner's output files are stored compressed, see servicecommon/payloads.py
+payloads = PayloadStore(metrics.CountingRedis(host='redis', port=6379), os.environ.get('PAYLOAD_DIR', '/home/app/payloads'),
+                        spill_threshold = int(os.environ.get('PAYLOAD_SPILL_THRESHOLD', 2**16)),
+                        expiry_time = expiry_time)
+
 def validate_transcript(transcript):
     return True
 
-def align():
-    completed_process = subprocess.run(
-        ["/opt/kaldi/egs/align/aligning_with_Docker/bin/align_in_singularity.sh",
-         "phone-finnish-finnish.csv", "false", "false", DataInDir, "no"], # "textDirTrue" as 4th arg to have separate text and audio dirs
-        cwd = '/opt/kaldi/egs/align', stderr = subprocess.PIPE, stdout = subprocess.PIPE) # to capture args, pass stdout = subprocess.PIPE, stderr = subprocess.PIPE
+# real-time factors
+def align(_id, duration):
+    align_started = time.time()
+    with metrics.pending('align', duration), metrics.in_progress('subprocesses'), metrics.stage('align'):
+        # in a session of its own, so that cancelling can kill the whole
+        # process group
+        process = subprocess.Popen(
+            ["/opt/kaldi/egs/align/aligning_with_Docker/bin/align_in_singularity.sh",
+             "phone-finnish-finnish.csv", "false", "false", DataInDir, "no"], # "textDirTrue" as 4th arg to have separate text and audio dirs
+            cwd = '/opt/kaldi/egs/align', stderr = subprocess.PIPE, stdout = subprocess.PIPE, # to capture args, pass stdout = subprocess.PIPE, stderr = subprocess.PIPE
+            start_new_session = True)
+        with aligning_lock:
+            aligning['jobid'], aligning['process'] = _id, process
+        if job_cancelled(_id):
+            kill_aligner(_id)
+        process.communicate()
+        with aligning_lock:
+            aligning['jobid'], aligning['process'] = None, None
+    if duration > 0:
+        metrics.histogram('real_time_factor', metrics.RTF_BUCKETS).observe((time.time() - align_started) / duration)
     submit_results()
 
+def job_cancelled(_id):
+    return redis_conn.hget(_id, 'status') == 'cancelled'
+
+def kill_aligner(_id):
+    """Kill the aligner if it's aligning _id."""
+    with aligning_lock:
+        if aligning['jobid'] == _id:
+            try:
+                os.killpg(aligning['process'].pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
 def not_ready_for_processing():
     return os.path.isdir(DataInDir) or os.path.isdir(DataOutDir)
 
 def submit_results():
-    dirname = os.listdir(DataOutDir)[0]
     id2result = {}
     try:
+        # no output if the aligner failed or was killed
+        dirname = os.listdir(DataOutDir)[0]
         for filename in os.listdir(os.path.join(DataOutDir, dirname)):
             if '.' not in filename:
                 continue
@@ -64,14 +112,17 @@ def submit_results():
     shutil.rmtree(DataInDir)
     shutil.rmtree(DataOutDir)
     for _id in id2result:
-        response = {'status': 'done', 'processing_finished': round(time.time(), 3)}
+        if job_cancelled(_id):
+            continue
+        response = {'status': 'done', 'processing_finished': round(time.time(), 3), **metrics.fields()}
         results = {}
         for suffix in id2result[_id]:
             results[suffix] = id2result[_id][suffix]
-        response['results'] = json.dumps(results)
-        redis_conn.hset(_id, mapping = response)
+        payloads.put(_id, 'results', results)
+        jobwait.finish(redis_conn, _id, response)
 
 @app.route('/audio/align/fi/submit_file', methods=["POST"])
+@metrics.collects_timings
 def route_submit_file():
     if request.content_length >= MAX_CONTENT_LENGTH:
         return jsonify({'error': 'body size exceeded maximum of {} bytes'}.format(MAX_CONTENT_LENGTH))
@@ -89,38 +140,133 @@ def route_submit_file():
     transcript = str(transcript_bytes, encoding='utf-8')
     if not validate_transcript(transcript):
         return jsonify({'error': 'transcript file appears invalid'})
+    return submit_alignment(audio, transcript, audio_file_name)
+
+def submit_alignment(audio, transcript, audio_file_name):
     _id = str(uuid.uuid4())
-    os.mkdir(DataInDirStaging)
-    audio.export(os.path.join(DataInDirStaging, _id + '.wav'), format='wav')
-    open(os.path.join(DataInDirStaging, _id + '.txt'), 'w', encoding="utf-8").write(transcript)
-    redis_conn.hset(_id, mapping = {'status': 'pending', 'task': 'finnish-forced-align', 'processing_started': round(time.time(), 3)})
-    redis_conn.expire(_id, expiry_time)
-    wait_counter = 0
-    while not_ready_for_processing():
-        time.sleep(1)
-        wait_counter += 1
-        if wait_counter > 25:
+    # the staging and data directories are shared by all request threads
+    wait_started = time.time()
+    with metrics.pending('wait', audio.duration_seconds):
+        if not staging_lock.acquire(timeout = STAGING_LOCK_TIMEOUT):
             return jsonify({'error': "service unavailable due to load, try again later"})
-    os.rename(DataInDirStaging, DataInDir)
-    os.mkdir(DataOutDir)
-    job = threading.Thread(target=align)
-    job.start()
+        try:
+            lock_wait = time.time() - wait_started
+            with metrics.stage('stage'):
+                os.mkdir(DataInDirStaging)
+                audio.export(os.path.join(DataInDirStaging, _id + '.wav'), format='wav')
+                open(os.path.join(DataInDirStaging, _id + '.txt'), 'w', encoding="utf-8").write(transcript)
+            redis_conn.hset(_id, mapping = {'status': 'pending', 'task': 'finnish-forced-align', 'processing_started': round(time.time(), 3)})
+            redis_conn.expire(_id, expiry_time)
+            wait_counter = 0
+            wait_started = time.time()
+            while not_ready_for_processing():
+                time.sleep(1)
+                wait_counter += 1
+                if job_cancelled(_id):
+                    shutil.rmtree(DataInDirStaging)
+                    return jsonify({'jobid': _id, 'status': 'cancelled'})
+                if wait_counter > 25:
+                    shutil.rmtree(DataInDirStaging)
+                    return jsonify({'error': "service unavailable due to load, try again later"})
+            # waiting for the staging directory and for the previous job to finish
+            metrics.record('wait', lock_wait + time.time() - wait_started)
+            redis_conn.hset(_id, mapping = metrics.fields())
+            os.rename(DataInDirStaging, DataInDir)
+            os.mkdir(DataOutDir)
+            job = threading.Thread(target = metrics.bind(align), args = (_id, audio.duration_seconds))
+            job.start()
+        finally:
+            staging_lock.release()
     return jsonify({'jobid': _id, 'file': audio_file_name})
 
+@app.route('/audio/align/fi/upload', methods=["POST"])
+def route_upload_create():
+    upload_id = uploads.create(request.args.get('filename', ''))
+    return jsonify({'uploadid': upload_id, 'offset': 0})
+
+@app.route('/audio/align/fi/upload/<upload_id>', methods=["GET", "PUT"])
+def route_upload(upload_id):
+    """GET returns how many bytes of audio have been received, PUT appends the
+    body at the offset given as a query parameter."""
+    try:
+        offset = int(request.args.get('offset', -1))
+    except ValueError:
+        # answered like any other wrong offset, with the one expected
+        offset = -1
+    try:
+        if request.method == 'PUT':
+            offset = uploads.write(upload_id, offset, request.stream)
+        else:
+            offset = uploads.offset(upload_id)
+    except UploadError as ex:
+        return jsonify({'error': str(ex), 'offset': ex.offset})
+    return jsonify({'uploadid': upload_id, 'offset': offset})
+
+@app.route('/audio/align/fi/upload/<upload_id>/finalize', methods=["POST"])
+@metrics.collects_timings
+def route_upload_finalize(upload_id):
+    """Start an alignment job on a completed audio upload, with the transcript
+    as the data payload."""
+    try:
+        audio_file_name = uploads.file_name(upload_id)
+    except UploadError as ex:
+        return jsonify({'error': str(ex)})
+    if '.' not in audio_file_name:
+        return jsonify({'error': 'could not determine audio file type'})
+    extension = audio_file_name[audio_file_name.rindex('.')+1:]
+    transcript = request.get_data(as_text = True)
+    if not validate_transcript(transcript):
+        return jsonify({'error': 'transcript file appears invalid'})
+    try:
+        audio = pydub.AudioSegment.from_file(uploads.data_path(upload_id), format=extension)
+    except Exception as ex:
+        return jsonify({'error': 'could not process audio file'})
+    uploads.discard(upload_id)
+    return submit_alignment(audio, transcript, audio_file_name)
+
 @app.route('/audio/align/fi/query_job', methods=["POST"])
+@metrics.counting_round_trips
 def route_query_job():
     _id = request.get_data(as_text = True)
+    jobwait.wait_for(redis_conn, _id, lambda: redis_conn.hget(_id, 'status') == 'pending',
+                     jobwait.wait_time(request.args))
     if _id not in redis_conn:
         return jsonify({'error': 'job id not available'})
     redis_hash = redis_conn.hgetall(_id)
+    timings = metrics.pop_timings(redis_hash)
+    if metrics.wants_timings(request.args):
+        redis_hash['timings'] = timings
     if 'processing_started' in redis_hash:
         redis_hash['processing_started'] = float(
             redis_hash['processing_started'])
     if 'processing_finished' in redis_hash:
         redis_hash['processing_finished'] = float(
             redis_hash['processing_finished'])
+    if redis_hash.get('status') == 'done' and 'results' not in redis_hash:
+        # results have always been returned as a json string
+        results = payloads.get(_id, 'results')
+        if results is None:
+            return jsonify({'error': 'job results not available'})
+        redis_hash['results'] = json.dumps(results)
     return jsonify(redis_hash)
 
+@app.route('/audio/align/fi/cancel', methods=["POST"])
+def route_cancel():
+    """Cancel a pending job. If it's being aligned, the aligner is killed, and
+    if it's still waiting for its turn, it won't be aligned."""
+    _id = request.get_data(as_text = True)
+    status = redis_conn.hget(_id, 'status')
+    if status is None:
+        return jsonify({'error': 'job id not available'})
+    if status == 'pending':
+        if jobwait.finish(redis_conn, _id, {'status': 'cancelled', 'processing_finished': round(time.time(), 3)}):
+            kill_aligner(_id)
+            status = 'cancelled'
+        else:
+            # the job finished first
+            status = redis_conn.hget(_id, 'status')
+    return jsonify({'jobid': _id, 'status': status})
+
 @app.route('/audio/align/fi/health', methods=["GET"])
 def route_health():
     response = {"status": "UP",
@@ -131,3 +277,5 @@ def route_health():
     except:
         pass
     return jsonify(response)
+
+metrics.add_route(app, 'finnish_forced_align')
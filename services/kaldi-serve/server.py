@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-from flask import Flask, request, Response, jsonify
+from flask import Flask, request, jsonify
 import json
 from io import BytesIO
 from kaldiserve import ChainModel, Decoder, parse_model_specs, start_decoding
@@ -17,7 +17,12 @@ import time
 import platform
 import re
 import subprocess
+import os
 from tempfile import TemporaryFile, NamedTemporaryFile
+from servicecommon.payloads import PayloadStore
+from servicecommon import jobwait
+from servicecommon import metrics
+from servicecommon.uploads import UploadSpool, UploadError
 
 MAX_CONTENT_LENGTH = 500 * 2**20
 
@@ -30,7 +35,7 @@ ASR_SEGMENTS = "asr_segments"
 ASR = "asr"
 expiry_time = 60 * 60 * 24 * 10
 
-redis_conn = redis.Redis(host="redis", port=6379, decode_responses=True)
+redis_conn = metrics.CountingRedis(host="redis", port=6379, decode_responses=True)
 
 # REDIS DATA MODEL
 # ----------------
@@ -39,18 +44,61 @@ redis_conn = redis.Redis(host="redis", port=6379, decode_responses=True)
 # be present:
 #
 # 1) type (ASR, ASR_SEGMENTS etc.)
-# 2) status (done, pending etc.)
+# 2) status (done, pending, cancelled etc.)
 # 3) processing_started (unix timestamp)
 #
 # Additionally, if the following are known, they will be in the hash (rather than in
 # a json blob somewhere)
 #
 # 4) processing_finished
-# 5) segments (json list of {duration, jobid})
-# 6) response (json object)
+# 5) timing:<stage> (seconds spent in each stage, see
+#    servicecommon/metrics.py). The stages are upload, transcode, vad, merge
+#    and submit_segments for a segmented job, and queue_wait (from submission
+#    until decoding started), lock_wait (the part of queue_wait spent waiting
+#    for the decoder) and decode for a job that is decoded as a whole.
+#
+# An ASR_SEGMENTS job is split into segments, which are decoded as jobs of
+# their own, but kept track of in the parent's hash:
+#
+# 6) segment_count, once the audio has been split
+# 7) segment:<index> (json {offset, duration, status}, and processing_started,
+#    processing_finished and timings once decoded)
+# 8) segments_done (how many segments have been decoded)
+# 9) submitted:<index>, once the segment has been submitted for decoding, so
+#    that it's decoded only once
+#
+# The parent is done when segments_done reaches segment_count.
+#
+# The response (json object) is stored through the PayloadStore, see
+# servicecommon/payloads.py, and the responses of a parent's segments in the hash "<jobid>:results", by
+# index. Jobs from before that have the response in the hash, and segmented
+# jobs have a segments field (json list of {duration, jobid}) and a hash per
+# segment.
+
+
+payloads = PayloadStore(
+    metrics.CountingRedis(host="redis", port=6379),
+    os.environ.get("PAYLOAD_DIR", "/home/app/payloads"),
+    spill_threshold=int(os.environ.get("PAYLOAD_SPILL_THRESHOLD", 2 ** 16)),
+    expiry_time=expiry_time,
+)
+
 
+uploads = UploadSpool(
+    os.environ.get("UPLOAD_DIR", "/home/app/uploads"),
+    expiry_time=60 * 60 * 24,
+)
 
-def update_response_from_redis_hash(response, redis_hash):
+
+def load_response(_id, redis_hash):
+    if "response" in redis_hash:
+        return json.loads(redis_hash["response"])
+    return payloads.get(_id, "response") or {}
+
+
+def update_response_from_redis_hash(response, redis_hash, timings=False):
+    if timings:
+        response["timings"] = metrics.pop_timings(redis_hash)
     response.update(
         {
             "status": redis_hash.get("status"),
@@ -70,6 +118,7 @@ decoder = Decoder(model)
 decoder_lock = threading.Lock()
 
 
+# real-time factors
 def valid_wav_header(data):
     if len(data) < 44:
         return False
@@ -84,17 +133,65 @@ def valid_wav_header(data):
     return True
 
 
-def decode(data, lock):
-    lock.acquire()
-    with start_decoding(decoder):
-        decoder.decode_wav_audio(data)
-        res = decoder.get_decoded_results(1, word_level=True, bidi_streaming=False)
-    lock.release()
+def wav_duration(data):
+    """Return the duration in seconds of wav data with a valid header."""
+    byte_rate = int.from_bytes(data[28:32], "little")
+    return (len(data) - 44) / byte_rate if byte_rate else 0.0
+
+
+def decode(data, lock, submitted=None, is_cancelled=None):
+    """Return the decoder's results for wav data. If is_cancelled() is true
+    once the decoder is free, return None without decoding."""
+    duration = wav_duration(data)
+    with metrics.pending("decode", duration):
+        with metrics.stage("lock_wait"):
+            lock.acquire()
+        try:
+            if is_cancelled is not None and is_cancelled():
+                return None
+            if submitted is not None:
+                metrics.record("queue_wait", time.time() - submitted)
+            decode_started = time.time()
+            with metrics.stage("decode"), start_decoding(decoder):
+                decoder.decode_wav_audio(data)
+                res = decoder.get_decoded_results(
+                    1, word_level=True, bidi_streaming=False
+                )
+        finally:
+            lock.release()
+    if duration > 0:
+        metrics.histogram("real_time_factor", metrics.RTF_BUCKETS).observe(
+            (time.time() - decode_started) / duration
+        )
     return res
 
 
-def decode_and_commit(data, _id, lock):
-    result = decode(data, lock)[0]  # only ever one result here
+def job_cancelled(_id):
+    return redis_conn.hget(_id, "status") == "cancelled"
+
+
+def cancel_job(_id):
+    """Mark a pending job cancelled, and return whether it was pending.
+    Decoding threads check this once they get the decoder, and
+    submit_segments() between segments, so cancelling a segmented job cancels
+    its segments."""
+    return jobwait.finish(
+        redis_conn,
+        _id,
+        {"status": "cancelled", "processing_finished": round(time.time(), 3)},
+    )
+
+
+def segment_field(index):
+    return "segment:{}".format(index)
+
+
+def decode_and_commit(data, _id, lock, submitted, index=None):
+    """Decode and store the result of job _id, or of its segment index."""
+    results = decode(data, lock, submitted, lambda: job_cancelled(_id))
+    if results is None or job_cancelled(_id):
+        return
+    result = results[0]  # only ever one result here
     response = {}
     response["responses"] = [
         {
@@ -110,22 +207,98 @@ def decode_and_commit(data, _id, lock):
             ],
         }
     ]
-    redis_conn.hset(
+    if index is not None:
+        commit_segment(_id, index, response, submitted)
+        return
+    payloads.put(_id, "response", response)
+    jobwait.finish(
+        redis_conn,
         _id,
-        mapping={
+        {
             "status": "done",
             "processing_finished": round(time.time(), 3),
-            "response": json.dumps(response),
+            **metrics.fields(),
         },
     )
 
 
+def claim_segment(_id, index):
+    """Return whether segment index of job _id is pending and not yet
+    submitted for decoding, and mark it submitted if so."""
+    segment = redis_conn.hget(_id, segment_field(index))
+    if segment is None or json.loads(segment)["status"] != "pending":
+        return False
+    return bool(redis_conn.hsetnx(_id, "submitted:{}".format(index), 1))
+
+
+def commit_segment(_id, index, response, submitted):
+    if not redis_conn.hexists(_id, segment_field(index)):
+        # the job has expired
+        return
+    payloads.put_item(_id, "results", index, response)
+    timings = metrics.pop_timings(metrics.fields())
+    # the segment is marked done and counted atomically, and only once
+    with redis_conn.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(_id)
+                segment = pipe.hget(_id, segment_field(index))
+                if segment is None or json.loads(segment)["status"] != "pending":
+                    return
+                segment = json.loads(segment)
+                segment.update(
+                    {
+                        "status": "done",
+                        "processing_started": submitted,
+                        "processing_finished": round(time.time(), 3),
+                        "timings": timings,
+                    }
+                )
+                pipe.multi()
+                pipe.hset(_id, segment_field(index), json.dumps(segment))
+                pipe.hincrby(_id, "segments_done", 1)
+                pipe.execute()
+                break
+            except redis.WatchError:
+                continue
+    finish_segmented(_id)
+
+
+def finish_segmented(_id):
+    """Mark a segmented job done if all its segments are."""
+    status, segment_count, segments_done = redis_conn.hmget(
+        _id, "status", "segment_count", "segments_done"
+    )
+    if status != "pending" or segment_count is None:
+        return
+    if int(segments_done or 0) < int(segment_count):
+        return
+    if jobwait.finish(
+        redis_conn,
+        _id,
+        {"status": "done", "processing_finished": round(time.time(), 3)},
+    ):
+        # the results last as long as the job from here on
+        payloads.expire_with_job(_id, "results")
+
+
 def segmented(audio, _id):
-    """Split audio, send parts to asr server, commit job ids to redis."""
+    """Split audio, send parts to asr server, track them in the job's hash."""
+    with metrics.pending("segment", audio.duration_seconds):
+        submit_segments(audio, _id)
+
+
+def submit_segments(audio, _id):
     min_segment = 5.0
-    segments = pydub.silence.split_on_silence(
-        audio, min_silence_len=360, silence_thresh=-36, keep_silence=True, seek_step=1
-    )
+    with metrics.stage("vad"):
+        segments = pydub.silence.split_on_silence(
+            audio,
+            min_silence_len=360,
+            silence_thresh=-36,
+            keep_silence=True,
+            seek_step=1,
+        )
+    merge_started = time.time()
     while len(segments) > 1:
         smallest_duration = audio.duration_seconds
         smallest_duration_idx = 0
@@ -151,45 +324,131 @@ def segmented(audio, _id):
             else:
                 segments[smallest_duration_idx] += segments[smallest_duration_idx + 1]
                 del segments[smallest_duration_idx + 1]
-    jobs = []
+    metrics.record("merge", time.time() - merge_started)
+    fields = {"segment_count": len(segments)}
+    offset = 0.0
     for i, segment in enumerate(segments):
-        f = TemporaryFile()
-        segment.export(f, format="wav")
-        f.seek(0)
-        audiobytes = f.read()
-        response = requests.post(submit_url, data=audiobytes)
-        jobs.append(
+        fields[segment_field(i)] = json.dumps(
             {
+                "offset": round(offset, 3),
                 "duration": segment.duration_seconds,
-                "jobid": json.loads(response.text)["jobid"],
+                "status": "pending",
             }
         )
-    redis_conn.hset(_id, key="segments", value=json.dumps(jobs))
+        offset += segment.duration_seconds
+    redis_conn.hset(_id, mapping={**fields, **metrics.fields()})
+    # a job without segments is done already
+    finish_segmented(_id)
+    with metrics.stage("submit_segments"):
+        for i, segment in enumerate(segments):
+            if job_cancelled(_id):
+                return
+            f = TemporaryFile()
+            segment.export(f, format="wav")
+            f.seek(0)
+            audiobytes = f.read()
+            requests.post(
+                submit_url, params={"parent": _id, "index": i}, data=audiobytes
+            )
+    redis_conn.hset(_id, mapping=metrics.fields())
+
+
+def wait_for_job(_id, timeout):
+    """Block until the job is no longer pending, or timeout seconds have
+    passed. A segmented job is pending until all its segments are done."""
+
+    def job_pending():
+        status, segments = redis_conn.hmget(_id, "status", "segments")
+        # old segmented jobs stay pending, see segment_list
+        return status == "pending" and segments is None
+
+    jobwait.wait_for(redis_conn, _id, job_pending, timeout)
+
+
+def segment_list(_id, redis_hash):
+    """Return the segments of a segmented job in order, as their fields in
+    the job's hash (see segment_field) plus their response, or None if a
+    result is missing. Segments of old jobs are read from their own hashes."""
+    if "segments" in redis_hash:
+        segments = []
+        offset = 0.0
+        for segment in json.loads(redis_hash["segments"]):
+            segment_redis_hash = redis_conn.hgetall(segment["jobid"])
+            if not segment_redis_hash:
+                return None
+            segments.append(
+                {
+                    "offset": offset,
+                    "duration": float(segment["duration"]),
+                    "status": segment_redis_hash["status"],
+                    "processing_started": float(
+                        segment_redis_hash["processing_started"]
+                    ),
+                    "timings": metrics.pop_timings(segment_redis_hash),
+                    "response": load_response(segment["jobid"], segment_redis_hash),
+                }
+            )
+            if "processing_finished" in segment_redis_hash:
+                segments[-1]["processing_finished"] = float(
+                    segment_redis_hash["processing_finished"]
+                )
+            offset += float(segment["duration"])
+        return segments
+    results = payloads.get_items(_id, "results")
+    segments = []
+    for index in range(int(redis_hash.get("segment_count", 0))):
+        segment = json.loads(redis_hash[segment_field(index)])
+        if str(index) not in results:
+            return None
+        segment["response"] = results[str(index)]
+        segments.append(segment)
+    return segments
 
 
 @app.route("/audio/asr/fi/submit", methods=["POST"])
+@metrics.collects_timings
 def route_submit():
-    audio_bytes = bytes(request.get_data(as_text=False))
+    """Start a job on wav data, or with the query parameters parent and
+    index, decode segment index of the segmented job parent."""
+    with metrics.stage("upload"):
+        audio_bytes = bytes(request.get_data(as_text=False))
     if not valid_wav_header(audio_bytes):
         return jsonify({"error": "invalid wav header"})
+    submitted = round(time.time(), 3)
+    if "parent" in request.args:
+        parent = request.args["parent"]
+        index = request.args.get("index", "")
+        if not index.isdigit() or not redis_conn.hexists(parent, segment_field(index)):
+            return jsonify({"error": "job id not available"})
+        if not claim_segment(parent, int(index)):
+            return jsonify({"error": "segment already submitted"})
+        job = threading.Thread(
+            target=metrics.bind(decode_and_commit),
+            args=(audio_bytes, parent, decoder_lock, submitted, int(index)),
+        )
+        job.start()
+        return jsonify({"jobid": parent, "index": int(index)})
     _id = str(uuid.uuid4())
     redis_conn.hset(
         _id,
         mapping={
             "type": ASR,
             "status": "pending",
-            "processing_started": round(time.time(), 3),
+            "processing_started": submitted,
+            **metrics.fields(),
         },
     )
     redis_conn.expire(_id, expiry_time)
     job = threading.Thread(
-        target=decode_and_commit, args=(audio_bytes, _id, decoder_lock)
+        target=metrics.bind(decode_and_commit),
+        args=(audio_bytes, _id, decoder_lock, submitted),
     )
     job.start()
     return jsonify({"jobid": _id})
 
 
 @app.route("/audio/asr/fi/submit_file", methods=["POST"])
+@metrics.collects_timings
 def route_submit_file():
     if request.content_length >= MAX_CONTENT_LENGTH:
         return jsonify(
@@ -200,14 +459,16 @@ def route_submit_file():
     if "nosplit" in args and args["nosplit"].lower() == "true":
         do_split = False
     if request.content_type.startswith("multipart/form-data"):
-        file_name = request.files["file"].filename
+        with metrics.stage("upload"):
+            file_name = request.files["file"].filename
         if "." not in file_name:
             return jsonify({"error": "could not determine file type"})
         extension = file_name[file_name.rindex(".") + 1 :]
         try:
-            audio = pydub.AudioSegment.from_file(
-                request.files["file"], format=extension
-            )
+            with metrics.stage("transcode"):
+                audio = pydub.AudioSegment.from_file(
+                    request.files["file"], format=extension
+                )
         except Exception as ex:
             return jsonify({"error": "could not process file"})
     else:
@@ -230,7 +491,8 @@ def route_submit_file():
                     "error": "expected either HTML form or mimetype audio/mpeg, audio/vorbis, audio/ogg, audio/wav or audio/x-wav"
                 }
             )
-        audio_file = BytesIO(request.get_data(as_text=False))
+        with metrics.stage("upload"):
+            audio_file = BytesIO(request.get_data(as_text=False))
 
         file_name = ""
         if "Content-Disposition" in request.headers:
@@ -241,38 +503,48 @@ def route_submit_file():
                 file_name = match.group(1)
 
         try:
-            audio = pydub.AudioSegment.from_file(audio_file, format=extension)
+            with metrics.stage("transcode"):
+                audio = pydub.AudioSegment.from_file(audio_file, format=extension)
         except Exception as ex:
             return jsonify({"error": "could not process file"})
 
+    return submit_audio(audio, extension, do_split, file_name)
+
+
+def submit_audio(audio, extension, do_split, file_name):
+    """Start an ASR job on audio, segmented unless do_split is false."""
     if extension == "wav":
         if audio.sample_width != 2 or audio.channels > 1 or audio.frame_rate != 16000:
+            transcode_started = time.time()
             downsample_tmp_read_f = NamedTemporaryFile(suffix=".wav")
             audio.export(downsample_tmp_read_f.name, format="wav")
             downsample_tmp_write_f = NamedTemporaryFile(suffix=".wav")
             # For some reason passing arguments to ffmpeg through pydub doesn't seem to work, so we do it this way.
             # -y means overwrite the (temporary) output file, -ac 1 means make it mono if it isn't already, and -c:a pcm_s16le means to use the standard 16 bit encoder for the audio codec
-            downsampler = subprocess.run(
-                [
-                    "ffmpeg",
-                    "-y",
-                    "-loglevel",
-                    "error",
-                    "-i",
-                    f"{downsample_tmp_read_f.name}",
-                    "-ac",
-                    "1",
-                    "-c:a",
-                    "pcm_s16le",
-                    "-ar",
-                    "16000",
-                    f"{downsample_tmp_write_f.name}",
-                ]
-            )
+            with metrics.in_progress("subprocesses"):
+                downsampler = subprocess.run(
+                    [
+                        "ffmpeg",
+                        "-y",
+                        "-loglevel",
+                        "error",
+                        "-i",
+                        f"{downsample_tmp_read_f.name}",
+                        "-ac",
+                        "1",
+                        "-c:a",
+                        "pcm_s16le",
+                        "-ar",
+                        "16000",
+                        f"{downsample_tmp_write_f.name}",
+                    ]
+                )
             audio = pydub.AudioSegment.from_file(
                 downsample_tmp_write_f.name, format=extension
             )
+            metrics.record("transcode", time.time() - transcode_started)
     _id = str(uuid.uuid4())
+    submitted = round(time.time(), 3)
 
     if not do_split:
         f = TemporaryFile()
@@ -284,12 +556,14 @@ def route_submit_file():
             mapping={
                 "type": ASR,
                 "status": "pending",
-                "processing_started": round(time.time(), 3),
+                "processing_started": submitted,
+                **metrics.fields(),
             },
         )
         redis_conn.expire(_id, expiry_time)
         job = threading.Thread(
-            target=decode_and_commit, args=(audio_bytes, _id, decoder_lock)
+            target=metrics.bind(decode_and_commit),
+            args=(audio_bytes, _id, decoder_lock, submitted),
         )
         job.start()
     else:
@@ -298,51 +572,105 @@ def route_submit_file():
             mapping={
                 "type": ASR_SEGMENTS,
                 "status": "pending",
-                "processing_started": round(time.time(), 3),
+                "processing_started": submitted,
+                **metrics.fields(),
             },
         )
         redis_conn.expire(_id, expiry_time)
-        job = threading.Thread(target=segmented, args=(audio, _id))
+        job = threading.Thread(target=metrics.bind(segmented), args=(audio, _id))
         job.start()
     return jsonify({"jobid": _id, "file": file_name})
 
 
+@app.route("/audio/asr/fi/upload", methods=["POST"])
+def route_upload_create():
+    upload_id = uploads.create(request.args.get("filename", ""))
+    return jsonify({"uploadid": upload_id, "offset": 0})
+
+
+@app.route("/audio/asr/fi/upload/<upload_id>", methods=["GET", "PUT"])
+def route_upload(upload_id):
+    """GET returns how many bytes have been received, PUT appends the body at
+    the offset given as a query parameter."""
+    try:
+        offset = int(request.args.get("offset", -1))
+    except ValueError:
+        # answered like any other wrong offset, with the one expected
+        offset = -1
+    try:
+        if request.method == "PUT":
+            offset = uploads.write(upload_id, offset, request.stream)
+        else:
+            offset = uploads.offset(upload_id)
+    except UploadError as ex:
+        return jsonify({"error": str(ex), "offset": ex.offset})
+    return jsonify({"uploadid": upload_id, "offset": offset})
+
+
+@app.route("/audio/asr/fi/upload/<upload_id>/finalize", methods=["POST"])
+@metrics.collects_timings
+def route_upload_finalize(upload_id):
+    """Start a job on a completed upload, as submit_file would. The file type
+    is taken from the file name given when creating the upload."""
+    try:
+        file_name = uploads.file_name(upload_id)
+    except UploadError as ex:
+        return jsonify({"error": str(ex)})
+    if "." not in file_name:
+        return jsonify({"error": "could not determine file type"})
+    extension = file_name[file_name.rindex(".") + 1 :]
+    do_split = request.args.get("nosplit", "").lower() != "true"
+    try:
+        with metrics.stage("transcode"):
+            audio = pydub.AudioSegment.from_file(
+                uploads.data_path(upload_id), format=extension
+            )
+    except Exception as ex:
+        return jsonify({"error": "could not process file"})
+    uploads.discard(upload_id)
+    return submit_audio(audio, extension, do_split, file_name)
+
+
 @app.route("/audio/asr/fi/query_job", methods=["POST"])
+@metrics.counting_round_trips
 def route_query_job():
     _id = request.get_data(as_text=True)
+    wait_for_job(_id, jobwait.wait_time(request.args))
+    timings = metrics.wants_timings(request.args)
     if _id not in redis_conn:
         return jsonify({"error": f"job id not available"})
     redis_hash = redis_conn.hgetall(_id)
-    response = json.loads(redis_hash.get("response", "{}"))
-    update_response_from_redis_hash(response, redis_hash)
+    response = load_response(_id, redis_hash)
+    update_response_from_redis_hash(response, redis_hash, timings)
     if redis_hash.get("type") == ASR:
         return jsonify(response)
     if redis_hash.get("type") != ASR_SEGMENTS:
         return jsonify({"error": "job id not available"})
-    if "segments" not in redis_hash:
-        return jsonify({"error": "internal server error"})
+    if redis_hash.get("status") == "cancelled":
+        return jsonify(response)
+    if redis_hash.get("status") != "done" and "segments" not in redis_hash:
+        return jsonify(response)
+    segments = segment_list(_id, redis_hash)
+    if segments is None:
+        return jsonify({"error": f"job id not available"})
     response["segments"] = []
-    segments = json.loads(redis_hash.get("segments"))
-    processing_finished = 0.0
-    running_time = 0.0
+    processing_finished = float(redis_hash.get("processing_finished", 0.0))
     for segment in segments:
-        segment_id = segment["jobid"]
-        if segment_id not in redis_conn:
-            return jsonify({"error": f"job id not available"})
-        segment_redis_hash = redis_conn.hgetall(segment_id)
-        if segment_redis_hash.get("status") == "pending":
+        if segment["status"] == "pending":
             return jsonify({"status": "pending"})
-        duration = float(segment["duration"])
-        segment_result = json.loads(segment_redis_hash.get("response", "{}"))
-        update_response_from_redis_hash(segment_result, segment_redis_hash)
-        segment_result["start"] = round(running_time, 3)
-        running_time += duration
-        segment_result["stop"] = round(running_time, 3)
-        segment_result["duration"] = round(running_time, 3)
-        if "processing_finished" in segment_result:
-            segment_processing_finished = float(segment_result["processing_finished"])
-            if segment_processing_finished > processing_finished:
-                processing_finished = segment_processing_finished
+        segment_result = segment["response"]
+        if timings:
+            segment_result["timings"] = segment["timings"]
+        segment_result["status"] = segment["status"]
+        segment_result["processing_started"] = segment["processing_started"]
+        if "processing_finished" in segment:
+            segment_result["processing_finished"] = segment["processing_finished"]
+            processing_finished = max(
+                processing_finished, segment["processing_finished"]
+            )
+        segment_result["start"] = round(segment["offset"], 3)
+        segment_result["stop"] = round(segment["offset"] + segment["duration"], 3)
+        segment_result["duration"] = segment_result["stop"]
         response["segments"].append(segment_result)
     response["processing_finished"] = processing_finished
     response["status"] = "done"
@@ -351,12 +679,15 @@ def route_query_job():
 
 
 @app.route("/audio/asr/fi/query_job/tekstiks", methods=["POST"])
+@metrics.counting_round_trips
 def route_query_job_tekstiks():
     tekstiks_version = "KP 0.1"
     no_job_error = 40
     internal_error = 41
+    cancelled_error = 42
     transcribing_failed_error = 1
     _id = request.get_data(as_text=True)
+    wait_for_job(_id, jobwait.wait_time(request.args))
     retval = {"id": _id, "metadata": {"version": tekstiks_version}}
     if _id not in redis_conn:
         retval["done"] = True
@@ -370,10 +701,14 @@ def route_query_job_tekstiks():
         retval["error"] = {"code": no_job_error, "message": "job id not found"}
         return jsonify(retval)
 
+    if retval["status"] == "cancelled":
+        retval["done"] = True
+        retval["error"] = {"code": cancelled_error, "message": "job was cancelled"}
+        return jsonify(retval)
+
     retval["result"] = {"speakers": {"S0": {}}, "sections": []}
-    running_time = 0.0
-    processing_finished = 0.0
-    if "segments" not in redis_hash:
+    processing_finished = float(redis_hash.get("processing_finished", 0.0))
+    if redis_hash["type"] == ASR:
         if retval["status"] != "done":
             retval["done"] = False
             retval["message"] = "In progress"
@@ -384,52 +719,72 @@ def route_query_job_tekstiks():
             "message": "job has incompatible api request",
         }
         return jsonify(retval)
-    segments = json.loads(redis_hash["segments"])
+    if retval["status"] != "done" and "segments" not in redis_hash:
+        retval["done"] = False
+        retval["message"] = "In progress"
+        return jsonify(retval)
+    segments = segment_list(_id, redis_hash)
+    if segments is None:
+        retval["error"] = {
+            "code": no_job_error,
+            "message": "one or more job segment id's not found",
+        }
+        retval["done"] = True
+        return jsonify(retval)
     for segment in segments:
-        segment_id = segment["jobid"]
-        if segment_id not in redis_conn:
-            retval["error"] = {
-                "code": no_job_error,
-                "message": "one or more job segment id's not found",
-            }
-            retval["done"] = True
-            return jsonify(retval)
-        segment_redis_hash = redis_conn.hgetall(segment_id)
-        segment_result = json.loads(segment_redis_hash.get("response", "{}"))
-        update_response_from_redis_hash(segment_result, segment_redis_hash)
-        if segment_result["status"] != "done":
+        if segment["status"] != "done":
             retval["done"] = False
             retval["message"] = "In progress"
             return jsonify(retval)
-        if segment_result.get("processing_finished", 0.0) > processing_finished:
-            processing_finished = segment_result["processing_finished"]
-        duration = float(segment["duration"])
+        processing_finished = max(
+            processing_finished, segment.get("processing_finished", 0.0)
+        )
+        segment_response = segment["response"]["responses"][0]
         retval["result"]["sections"].append(
             {
-                "start": round(running_time, 3),
-                "end": round(running_time + duration, 3),
-                "transcript": segment_result["responses"][0]["transcript"],
-                "words": [],
+                "start": round(segment["offset"], 3),
+                "end": round(segment["offset"] + segment["duration"], 3),
+                "transcript": segment_response["transcript"],
+                "words": segment_response.get("words", []),
             }
         )
-        running_time += duration
-        if "words" in segment_result["responses"][0]:
-            retval["result"]["sections"][-1]["words"] = segment_result["responses"][0][
-                "words"
-            ]
     retval["status"] = "done"
     retval["done"] = True
     retval["processing_finished"] = processing_finished
     return jsonify(retval)
 
 
+@app.route("/audio/asr/fi/cancel", methods=["POST"])
+def route_cancel():
+    """Cancel a job and all its segments that haven't been decoded yet.
+    A segment that is being decoded finishes, but isn't committed."""
+    _id = request.get_data(as_text=True)
+    redis_hash = redis_conn.hgetall(_id)
+    if redis_hash.get("type") not in (ASR, ASR_SEGMENTS):
+        return jsonify({"error": "job id not available"})
+    status = redis_hash.get("status")
+    if "segments" in redis_hash:
+        # old segmented jobs stay pending, and their segments won't be decoded
+        # by now if they weren't already
+        status = "done"
+    if status != "pending":
+        return jsonify({"jobid": _id, "status": status})
+    if not cancel_job(_id):
+        # finished before it could be cancelled
+        return jsonify({"jobid": _id, "status": redis_conn.hget(_id, "status")})
+    return jsonify({"jobid": _id, "status": "cancelled"})
+
+
 @app.route("/audio/asr/fi/segmented", methods=["POST"])
+@metrics.collects_timings
 def route_segmented():
-    audio_bytes = bytes(request.get_data(as_text=False))
+    with metrics.stage("upload"):
+        audio_bytes = bytes(request.get_data(as_text=False))
     if not valid_wav_header(audio_bytes):
         return jsonify({"error": "invalid wav header"})
     f = BytesIO(audio_bytes)
-    audio = pydub.AudioSegment.from_file(f, format="wav")
+    with metrics.stage("transcode"):
+        audio = pydub.AudioSegment.from_file(f, format="wav")
     _id = str(uuid.uuid4())
     redis_conn.hset(
         _id,
@@ -437,10 +792,11 @@ def route_segmented():
             "type": ASR_SEGMENTS,
             "status": "pending",
             "processing_started": round(time.time(), 3),
+            **metrics.fields(),
         },
     )
     redis_conn.expire(_id, expiry_time)
-    job = threading.Thread(target=segmented, args=(audio, _id))
+    job = threading.Thread(target=metrics.bind(segmented), args=(audio, _id))
     job.start()
     return jsonify({"jobid": _id})
 
@@ -476,6 +832,9 @@ def route_health():
     return jsonify(response)
 
 
+metrics.add_route(app, "kaldi_serve")
+
+
 @app.route("/audio/asr/fi/self_test", methods=["GET"])
 def route_self_test():
     try:
@@ -1,13 +1,23 @@
 # import sys
-from subprocess import Popen, PIPE
-from flask import Flask, request, jsonify
+import os
 import time
+from subprocess import Popen, PIPE
+from flask import Flask, Response, request, jsonify
 import redis
-import uuid
 import json
-import threading
+import re
+from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 from . import cnn_sentiment
-from tempfile import NamedTemporaryFile
+from .jobs import JobQueue
+from . import jobs
+from servicecommon.payloads import PayloadStore
+from servicecommon import jobwait
+from .cache import SentenceCache
+from . import morphology
+from servicecommon import metrics
+import numpy as np
 import logging
 import requests
 # from sqlitedict import SqliteDict
@@ -15,166 +25,564 @@ import requests
 app = Flask("kielipankki-services")
 s24_sentiment = cnn_sentiment.s24
 
-redis_conn = redis.Redis(host='redis', port=6379, decode_responses = True)
+redis_conn = metrics.CountingRedis(host='redis', port=6379, decode_responses = True)
 
 expiry_time = 60*60*24*10
 
+# Per-sentence postag results, sentiment features and conllu2svg trees are
+# cached in a separate redis with LRU eviction. FinnPos tags each sentence on
+# its own, so postag results of a tokenized sentence don't depend on its
+# neighbours. nertag isn't cached, as it uses context across sentences.
+cache_conn = metrics.CountingRedis(host=os.environ.get('CACHE_HOST', 'redis-cache'), port=6379,
+                         socket_connect_timeout = 0.5, socket_timeout = 0.5)
+sentence_cache = SentenceCache(cache_conn)
+
+# Morphological analysis for postag in this process, with the analyses of
+# frequent word forms memoized, if enabled with POSTAG_IN_PROCESS, see
+# morphology.py
+analyser = morphology.Analyser() if morphology.available() else None
+
+# Long texts are split into chunks of about CHUNK_SIZE characters, see
+# paragraph_chunks. The chunks of all requests share one pool of
+# TAGGER_PROCESSES threads, so at most that many chunks are tagged at once
+# per gunicorn worker, whatever the number of request threads. annotate runs
+# three tools per chunk.
+CHUNK_SIZE = int(os.environ.get('CHUNK_SIZE', 2**16))
+TAGGER_PROCESSES = int(os.environ.get('TAGGER_PROCESSES', 2))
+tagger_executor = ThreadPoolExecutor(max_workers = TAGGER_PROCESSES)
+
+# Marks the boundaries between documents in batch requests
+DOCUMENT_SEPARATOR = "KIELIPANKKIDOCUMENTSEPARATOR"
+
+# Part of the cache keys, update along with finnish-tagtools and
+# conllu-viewer in the Dockerfile
+TAGTOOLS_VERSION = "1.6.0"
+CONLLU_VIEWER_VERSION = "1"
+
+# job results are stored compressed, see servicecommon/payloads.py
+payloads = PayloadStore(metrics.CountingRedis(host='redis', port=6379), os.environ.get('PAYLOAD_DIR', '/usr/src/app/payloads'),
+                        spill_threshold = int(os.environ.get('PAYLOAD_SPILL_THRESHOLD', 2**16)),
+                        expiry_time = expiry_time)
+
+job_queue = JobQueue(redis_conn, payloads, expiry_time,
+                     max_workers = int(os.environ.get('JOB_WORKERS', 2)),
+                     max_queued = int(os.environ.get('JOB_QUEUE_LENGTH', 64)))
+metrics.gauge_function('queued_jobs', lambda: job_queue.queued)
+
 base_url = "http://nginx:1337/text/fi"
 
-def sanitize_response(response):
-    response.pop('type', None)
+# finnish-tagtools option for input that is already one token per line,
+# with empty lines between sentences
+TOKENIZED_INPUT = "--no-tokenize"
 
-@app.route('/text/fi/postag', methods=['POST'])
-def postag():
-    tagger = Popen(["finnish-postag"], encoding = 'utf-8', stdin = PIPE, stdout = PIPE)
-    out, err = tagger.communicate(request.get_data(as_text = True))
-    sentences = []
-    for sentence in out.split('\n\n'):
-        this_sentence = []
-        for line in sentence.split('\n'):
-            if line.strip() != '':
-                this_sentence.append(line.split('\t'))
-        if len(this_sentence) > 0:
-            sentences.append(this_sentence)
-    return jsonify(sentences)
-    
-@app.route('/text/fi/nertag', methods=['POST'])
-def nertag():
-    args = request.args
-    process_args = ["finnish-nertag"]
-    if 'show-analyses' in args and args['show-analyses'].lower() == 'true':
-        process_args.append("--show-analyses")
-    tagger = Popen(process_args, encoding='utf-8', stdin = PIPE, stdout = PIPE)
-    out, err = tagger.communicate(request.get_data(as_text = True))
+SPAWN_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+def run_tool(process_args, data):
+    tool = os.path.basename(process_args[0])
+    job = jobs.current_job()
+    if job is not None and job.cancelled:
+        raise jobs.Cancelled()
+    metrics.inc('tool_runs_total', tool = tool)
+    started = time.time()
+    with metrics.in_progress('subprocesses'):
+        # in a session of its own, so that cancelling the job can kill the
+        # tool's whole pipeline
+        process = Popen(process_args, encoding = 'utf-8', stdin = PIPE, stdout = PIPE,
+                        start_new_session = True)
+        metrics.histogram('tool_spawn_seconds', SPAWN_BUCKETS, tool = tool).observe(time.time() - started)
+        if job is None:
+            out, err = process.communicate(data)
+        else:
+            job.started(process)
+            try:
+                out, err = process.communicate(data)
+            finally:
+                job.finished(process)
+    metrics.histogram('tool_seconds', tool = tool).observe(time.time() - started)
+    return out
+
+def parse_sentences(out, split_fields = True):
+    """Parse blank-line separated tool output into a list of sentences.
+
+    Each sentence is a list of lines, or of tab-separated fields if
+    split_fields is true."""
     sentences = []
     for sentence in out.split('\n\n'):
         this_sentence = []
         for line in sentence.split('\n'):
             if line.strip() != '':
-                this_sentence.append(line.split('\t'))
+                this_sentence.append(line.split('\t') if split_fields else line)
         if len(this_sentence) > 0:
             sentences.append(this_sentence)
-    return jsonify(sentences)
+    return sentences
 
-def nertag_and_commit(to_tag, args, _id):
-    if _id not in redis_conn:
-        return
-    redis_entry = redis_conn.hgetall(_id)
+def tokenize(data):
+    with metrics.stage('tokenize'):
+        return parse_sentences(run_tool(["finnish-tokenize"], data), split_fields = False)
+
+def tokenized_text(sentences):
+    """Render tokenized sentences in the one-token-per-line format the
+    tagtools accept with --no-tokenize."""
+    return ''.join('\n'.join(sentence) + '\n\n' for sentence in sentences)
+
+def nertag_process_args(args):
     process_args = ["finnish-nertag"]
     if 'show-analyses' in args and args['show-analyses'].lower() == 'true':
         process_args.append("--show-analyses")
-    tagger = Popen(process_args, encoding='utf-8', stdin = PIPE, stdout = PIPE)
-    out, err = tagger.communicate(to_tag)
+    return process_args
+
+def tag_tokenized(process_args, sentences):
+    return parse_sentences(run_tool(process_args + [TOKENIZED_INPUT], tokenized_text(sentences)))
+
+def postag_tokenized(sentences):
+    if analyser is None:
+        return tag_tokenized(["finnish-postag"], sentences)
+    return parse_sentences(run_tool(morphology.after_lookup_args(), analyser.lookup_output(sentences)))
+
+def postag_sentences(sentences):
+    # in-process analysis gets keys of its own in case it's misconfigured
+    version = TAGTOOLS_VERSION if analyser is None else TAGTOOLS_VERSION + '-lookup'
+    with metrics.stage('tag'):
+        return sentence_cache.lookup('postag', version, [], sentences, postag_tokenized)
+
+def nertag_sentences(sentences, args):
+    with metrics.stage('tag'):
+        return tag_tokenized(nertag_process_args(args), sentences)
+
+def tag_chunk(process_args, chunk):
+    """Run a tagger on text, tokenizing it as the tagger does by default."""
+    with metrics.stage('tag'):
+        return parse_sentences(run_tool(process_args, chunk))
+
+def sentiment_features(sentences):
+    """Return the sentiment model's pooled features for each sentence, or
+    None if there are no sentences."""
+    if len(sentences) == 0:
+        return None
+    with metrics.stage('sentiment'):
+        return np.stack(sentence_cache.lookup(
+            'sentiment', s24_sentiment.version, [], sentences, s24_sentiment.sentence_features,
+            encode = lambda features: features.tobytes(),
+            decode = lambda value: np.frombuffer(value, dtype = np.float32)))
+
+# Where text_pieces splits text: at empty lines, and pieces that are still
+# longer than CHUNK_SIZE at line breaks and then after sentence-ending
+# punctuation. The separators are captured so the pieces join back up.
+PIECE_SPLITS = [r'(\n[ \t\r]*\n)', r'(\n)', r'((?<=[.!?])\s+)']
+
+def text_pieces(text, level = 0):
+    """Yield (separator, piece) pairs that join back up into text, see
+    PIECE_SPLITS. The first separator is empty."""
+    parts = re.split(PIECE_SPLITS[level], text)
+    separator = ''
+    for i in range(0, len(parts), 2):
+        if len(parts[i]) > CHUNK_SIZE and level + 1 < len(PIECE_SPLITS):
+            for j, (inner_separator, piece) in enumerate(text_pieces(parts[i], level + 1)):
+                yield (separator if j == 0 else inner_separator), piece
+        else:
+            yield separator, parts[i]
+        if i + 1 < len(parts):
+            separator = parts[i + 1]
+
+def paragraph_chunks(text):
+    """Yield pieces of text of about CHUNK_SIZE characters. Chunks end at
+    empty lines, so a sentence is only split between chunks if it spans an
+    empty line, or if its paragraph is longer than CHUNK_SIZE and the
+    paragraph has to be split at a line break or what looks like the end of
+    a sentence."""
+    chunk = []
+    length = 0
+    for separator, piece in text_pieces(text):
+        if len(chunk) > 0:
+            chunk.append(separator)
+        chunk.append(piece)
+        length += len(piece)
+        if length >= CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if len(chunk) > 0:
+        yield ''.join(chunk)
+
+def chunked(text, process_chunk):
+    """Yield process_chunk(chunk) for each paragraph chunk of text, in order."""
+    return process_concurrently(paragraph_chunks(text), process_chunk)
+
+def process_concurrently(chunks, process_chunk):
+    """Yield process_chunk(chunk) for each of chunks, in order.
+
+    Chunks are processed concurrently by up to TAGGER_PROCESSES workers, and
+    only a limited number of them are submitted ahead of the one being
+    yielded, so memory use doesn't grow with the length of the input."""
+    pending = deque()
+    process_chunk = jobs.bind(process_chunk)
+    for chunk in chunks:
+        pending.append(tagger_executor.submit(process_chunk, chunk))
+        if len(pending) >= 2 * TAGGER_PROCESSES:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+def postag_chunks(text, args):
+    return chunked(text, lambda chunk: postag_sentences(tokenize(chunk)))
+
+def nertag_chunks(text, args):
+    process_args = nertag_process_args(args)
+    return chunked(text, lambda chunk: tag_chunk(process_args, chunk))
+
+def sentiment_chunk(chunk):
+    """Return the (sentence, sentiment) pairs of chunk, and the elementwise
+    maximum of its sentence features for scoring the whole document."""
+    sentences = tokenize(chunk)
+    features = sentiment_features(sentences)
+    if features is None:
+        return [], None
+    return list(zip(sentences, s24_sentiment.list(sentences, features))), features.max(axis = 0)
+
+def annotate_sentences(tokenized_sentences):
+    """Run postag, nertag and sentiment concurrently on the same tokenized
+    sentences, so that the sentences line up by construction."""
+    if len(tokenized_sentences) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers = 3) as executor:
+        postag_job = executor.submit(jobs.bind(postag_sentences), tokenized_sentences)
+        nertag_job = executor.submit(jobs.bind(nertag_sentences), tokenized_sentences, {})
+        features_job = executor.submit(jobs.bind(sentiment_features), tokenized_sentences)
+        sentiments = s24_sentiment.list(tokenized_sentences, features_job.result())
+        postagged_sentences = postag_job.result()
+        nertagged_sentences = nertag_job.result()
     sentences = []
-    for sentence in out.split('\n\n'):
-        this_sentence = []
-        for line in sentence.split('\n'):
-            if line.strip() != '':
-                this_sentence.append(line.split('\t'))
-        if len(this_sentence) > 0:
-            sentences.append(this_sentence)
-    redis_entry['result'] = json.dumps(sentences)
-    redis_entry['processing_finished'] = round(time.time(), 3)
-    redis_entry['status'] = 'done'
-    redis_conn.hset(_id, mapping = redis_entry)
-
-@app.route('/text/fi/nertag/query_job', methods=['POST'])
-def nertag_query():
-    _id = request.get_data(as_text = True)
-    if _id not in redis_conn:
-        return jsonify({'error': 'job id not available'})
-    response = redis_conn.hgetall(_id)
-    if response.get('type') != 'ner':
-        return jsonify({'error': 'job id not available'})
-    if response.get('status') == 'pending':
-        return jsonify({'status': 'pending'})
-    sanitize_response(response)
-    response['result'] = json.loads(response.get('result'))
-    response['processing_started'] = float(response.get('processing_started'))
-    response['processing_finished'] = float(response.get('processing_finished'))
-    return jsonify(response)
+    for postagged, nertagged, sentence_sentiment in zip(postagged_sentences, nertagged_sentences, sentiments):
+        sentences.append({'postagged': postagged, 'nertagged': nertagged, 'sentiment': sentence_sentiment})
+    return sentences
+
+def annotate_chunk(chunk):
+    return annotate_sentences(tokenize(chunk))
+
+def annotate_chunks(text, args):
+    return chunked(text, annotate_chunk)
+
+def max_features(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return np.maximum(a, b)
+
+def postag_text(text, args):
+    return list(chain.from_iterable(postag_chunks(text, args)))
+
+def nertag_text(text, args):
+    return list(chain.from_iterable(nertag_chunks(text, args)))
+
+def sentiment_text(text, args):
+    results = []
+    document_features = None
+    for chunk_results, chunk_features in chunked(text, sentiment_chunk):
+        results.extend(chunk_results)
+        document_features = max_features(document_features, chunk_features)
+    # the last entry is the whole document
+    document = list(chain.from_iterable(sentence for sentence, sentence_sentiment in results))
+    results.append((document, s24_sentiment.document_sentiment(document_features)))
+    return {'sentiment': results}
+
+def sentiment_lines(text, args):
+    """Like sentiment_text, but yield each (sentence, sentiment) pair as soon
+    as it's known, and finally {"document": sentiment}."""
+    document_features = None
+    for chunk_results, chunk_features in chunked(text, sentiment_chunk):
+        yield from chunk_results
+        document_features = max_features(document_features, chunk_features)
+    yield {'document': s24_sentiment.document_sentiment(document_features)}
+
+def annotate_text(text, args):
+    return list(chain.from_iterable(annotate_chunks(text, args)))
+
+def conllu2html_text(text, args):
+    # conllu2svg reads the file it's given, not stdin, so give it stdin as a
+    # file rather than writing a temporary one for every render
+    return run_tool(["conllu2svg", "/dev/stdin"], text)
+
+def top_level_svgs(html):
+    """Return the outermost <svg> elements of html, including any svg
+    elements nested in them."""
+    svgs = []
+    depth = 0
+    for tag in re.finditer(r'<(/?)svg\b[^>]*>', html):
+        if tag.group(1) == '/':
+            depth -= 1
+            if depth < 0:
+                raise RuntimeError("unmatched </svg> in conllu2svg output")
+            if depth == 0:
+                svgs.append(html[start:tag.end()])
+        elif not tag.group(0).endswith('/>'):
+            if depth == 0:
+                start = tag.start()
+            depth += 1
+        elif depth == 0:
+            svgs.append(tag.group(0))
+    if depth != 0:
+        raise RuntimeError("unclosed <svg> in conllu2svg output")
+    return svgs
+
+def conllu_blocks(text):
+    """Split a CoNLL-U document into the lines of each sentence."""
+    return [block.split('\n') for block in re.split(r'\n[ \t\r]*\n', text.strip())
+            if block.strip() != '']
+
+def render_svgs(blocks):
+    """Render the trees of all the CoNLL-U blocks in one conllu2svg run."""
+    out = conllu2html_text(tokenized_text(blocks), {})
+    svgs = top_level_svgs(out)
+    if len(svgs) != len(blocks):
+        raise RuntimeError("conllu2svg rendered {} trees for {} sentences".format(len(svgs), len(blocks)))
+    return svgs
+
+def conllu2svg_text(text, args):
+    return sentence_cache.lookup('conllu2svg', CONLLU_VIEWER_VERSION, [], conllu_blocks(text), render_svgs)
+
+def wants_stream(args):
+    return args.get('stream', '').lower() == 'true'
+
+def ndjson_response(lines):
+    """Stream lines as newline-delimited json, past nginx's buffering."""
+    return Response((json.dumps(line) + '\n' for line in lines),
+                    mimetype = 'application/x-ndjson',
+                    headers = {'X-Accel-Buffering': 'no'})
+
+# With stream=true, these return one sentence per line as chunks complete
+@app.route('/text/fi/postag', methods=['POST'])
+def postag():
+    if wants_stream(request.args):
+        return ndjson_response(chain.from_iterable(
+            postag_chunks(request.get_data(as_text = True), request.args.to_dict())))
+    return jsonify(postag_text(request.get_data(as_text = True), request.args))
     
-@app.route('/text/fi/nertag/submit', methods=['POST'])
-def nertag_submit():
-    args = request.args
-    _id = str(uuid.uuid4())
-    redis_conn.hset(_id, mapping = {'type': 'ner', 'status': 'pending', 'processing_started': round(time.time(), 3)})
-    redis_conn.expire(_id, expiry_time)
-    to_tag = request.get_data(as_text = True)
-    job = threading.Thread(target=nertag_and_commit, args=(to_tag, args, _id))
-    job.start()
-    return jsonify({'jobid': _id})
+@app.route('/text/fi/nertag', methods=['POST'])
+def nertag():
+    if wants_stream(request.args):
+        return ndjson_response(chain.from_iterable(
+            nertag_chunks(request.get_data(as_text = True), request.args.to_dict())))
+    return jsonify(nertag_text(request.get_data(as_text = True), request.args))
 
 @app.route('/text/fi/sentiment', methods=['POST'])
 def sentiment():
-    tokenizer = Popen(["finnish-tokenize"], encoding = 'utf-8',
-                      stdin = PIPE, stdout = PIPE)
-    out, err = tokenizer.communicate(request.get_data(as_text = True))
-    sentences = []
-    for sentence in out.split('\n\n'):
-        this_sentence = []
-        for line in sentence.split('\n'):
-            if line.strip() != '':
-                this_sentence.append(line)
-        if len(this_sentence) > 0:
-            sentences.append(this_sentence)
-    sentences.append(sum(sentences, []))
-    sentiments = s24_sentiment.list(sentences)
-    return jsonify(sentiment=list(zip(sentences, sentiments)))
+    if wants_stream(request.args):
+        return ndjson_response(sentiment_lines(request.get_data(as_text = True), request.args.to_dict()))
+    return jsonify(sentiment_text(request.get_data(as_text = True), request.args))
 
 @app.route('/text/fi/annotate', methods=['POST'])
 def annotate():
-    sentences = []
-    data = request.get_data(as_text = True)
-    tagger = Popen(["finnish-postag"], encoding = 'utf-8', stdin = PIPE, stdout = PIPE)
-    out, err = tagger.communicate(data)
-    postag_sentences = []
-    for sentence in out.split('\n\n'):
-        this_sentence = []
-        for line in sentence.split('\n'):
-            if line.strip() != '':
-                this_sentence.append(line.split('\t'))
-        if len(this_sentence) > 0:
-            postag_sentences.append(this_sentence)
+    if wants_stream(request.args):
+        return ndjson_response(chain.from_iterable(
+            annotate_chunks(request.get_data(as_text = True), request.args.to_dict())))
+    return jsonify(annotate_text(request.get_data(as_text = True), request.args))
 
-    tagger = Popen(["finnish-nertag"], encoding='utf-8', stdin = PIPE, stdout = PIPE)
-    out, err = tagger.communicate(data)
-    nertag_sentences = []
-    for sentence in out.split('\n\n'):
-        this_sentence = []
-        for line in sentence.split('\n'):
-            if line.strip() != '':
-                this_sentence.append(line.split('\t'))
-        if len(this_sentence) > 0:
-            nertag_sentences.append(this_sentence)
+@app.route('/utils/conllu2html', methods=['POST'])
+def conllu2html():
+    return conllu2html_text(request.get_data(as_text = True), request.args)
 
+# A json list of the svg of each sentence in a CoNLL-U document, with trees
+# that have been rendered before taken from the cache
+@app.route('/utils/conllu2svg', methods=['POST'])
+def conllu2svg():
+    return jsonify(conllu2svg_text(request.get_data(as_text = True), request.args))
 
-    tokenizer = Popen(["finnish-tokenize"], encoding = 'utf-8',
-                      stdin = PIPE, stdout = PIPE)
-    out, err = tokenizer.communicate(data)
-    sentiment_sentences = []
-    for sentence in out.split('\n\n'):
+# Every tool also has <path>/submit, <path>/query_job and <path>/cancel
+# endpoints for jobs that may take longer than the request timeout. The job
+# type of nertag is "ner" for compatibility with jobs submitted before the
+# other tools had one.
+job_tools = {
+    'postag': ('/text/fi/postag', 'postag', postag_text),
+    'nertag': ('/text/fi/nertag', 'ner', nertag_text),
+    'sentiment': ('/text/fi/sentiment', 'sentiment', sentiment_text),
+    'annotate': ('/text/fi/annotate', 'annotate', annotate_text),
+    'conllu2html': ('/utils/conllu2html', 'conllu2html', conllu2html_text),
+    'conllu2svg': ('/utils/conllu2svg', 'conllu2svg', conllu2svg_text),
+}
+
+def make_submit_route(job_type, function):
+    def route_submit():
+        _id = job_queue.submit(job_type, function, request.get_data(as_text = True),
+                               request.args.to_dict())
+        if _id is None:
+            return jsonify({'error': "service unavailable due to load, try again later"})
+        return jsonify({'jobid': _id})
+    return route_submit
+
+def make_cancel_route(job_type):
+    def route_cancel():
+        return jsonify(job_queue.cancel(request.get_data(as_text = True), job_type))
+    return route_cancel
+
+def make_query_route(tool, job_type):
+    def route_query_job():
+        return jsonify(job_queue.query(request.get_data(as_text = True), job_type,
+                                       jobwait.wait_time(request.args),
+                                       metrics.wants_timings(request.args)))
+    return metrics.counting_round_trips(route_query_job, route = tool + '_query')
+
+for tool, (path, job_type, function) in job_tools.items():
+    app.add_url_rule(path + '/submit', tool + '_submit',
+                     make_submit_route(job_type, function), methods=['POST'])
+    app.add_url_rule(path + '/query_job', tool + '_query',
+                     make_query_route(tool, job_type), methods=['POST'])
+    app.add_url_rule(path + '/cancel', tool + '_cancel',
+                     make_cancel_route(job_type), methods=['POST'])
+
+class SeparatorInText(ValueError):
+    pass
+
+def join_documents(texts):
+    return ('\n\n' + DOCUMENT_SEPARATOR + '\n\n').join(texts)
+
+def split_at_separator(sentences, n_documents, is_separator):
+    """Split the sentences of a tool's output for join_documents(texts) into
+    the sentences of each text. is_separator(line) tells which lines are the
+    separator."""
+    documents = [[]]
+    for sentence in sentences:
         this_sentence = []
-        for line in sentence.split('\n'):
-            if line.strip() != '':
+        for line in sentence:
+            if is_separator(line):
+                if len(this_sentence) > 0:
+                    documents[-1].append(this_sentence)
+                this_sentence = []
+                documents.append([])
+            else:
                 this_sentence.append(line)
         if len(this_sentence) > 0:
-            sentiment_sentences.append(this_sentence)
-    sentiments = s24_sentiment.list(sentiment_sentences)
+            documents[-1].append(this_sentence)
+    if len(documents) != n_documents:
+        raise SeparatorInText("document separator found in input text")
+    return documents
 
-    for i in range(max(len(postag_sentences), len(nertag_sentences), len(sentiments))):
-        sentences.append({'postagged': postag_sentences[i], 'nertagged': nertag_sentences[i], 'sentiment': sentiments[i]})
-    return jsonify(sentences)
+def tokenize_documents(texts):
+    """Tokenize several texts in one tokenizer run, returning the list of
+    sentences of each text."""
+    if len(texts) == 0:
+        return []
+    return split_at_separator(tokenize(join_documents(texts)), len(texts),
+                              lambda token: token == DOCUMENT_SEPARATOR)
 
-@app.route('/utils/conllu2html', methods=['POST'])
-def conllu2html():
+def tag_documents(process_args, texts):
+    """Tag several texts in one tagger run as tag_chunk would, returning the
+    list of tagged sentences of each text."""
+    if len(texts) == 0:
+        return []
+    return split_at_separator(tag_chunk(process_args, join_documents(texts)), len(texts),
+                              lambda fields: fields[0] == DOCUMENT_SEPARATOR)
+
+def document_chunks(texts):
+    """Yield lists of consecutive texts of about CHUNK_SIZE characters
+    together. Texts aren't split."""
+    chunk = []
+    length = 0
+    for text in texts:
+        chunk.append(text)
+        length += len(text)
+        if length >= CHUNK_SIZE:
+            yield chunk
+            chunk = []
+            length = 0
+    if len(chunk) > 0:
+        yield chunk
+
+def batched(texts, process_documents):
+    """Return the concatenation of process_documents(chunk) for the document
+    chunks of texts, processed concurrently like the chunks of a long text."""
+    return list(chain.from_iterable(process_concurrently(document_chunks(texts), process_documents)))
+
+def split_documents(documents, results):
+    """Split per-sentence results of all the sentences of documents into a
+    list of results per document."""
+    retval = []
+    start = 0
+    for document in documents:
+        retval.append(results[start:start + len(document)])
+        start += len(document)
+    return retval
+
+def postag_documents(texts):
+    documents = tokenize_documents(texts)
+    return split_documents(documents, postag_sentences(list(chain.from_iterable(documents))))
+
+def postag_batch(texts, args):
+    return batched(texts, postag_documents)
+
+def nertag_batch(texts, args):
+    process_args = nertag_process_args(args)
+    return batched(texts, lambda chunk: tag_documents(process_args, chunk))
+
+def sentiment_documents(texts):
+    documents = tokenize_documents(texts)
+    sentences = list(chain.from_iterable(documents))
+    features = sentiment_features(sentences)
+    sentiments = s24_sentiment.list(sentences, features)
+    retval = []
+    start = 0
+    for document in documents:
+        end = start + len(document)
+        document_features = features[start:end].max(axis = 0) if end > start else None
+        results = list(zip(document, sentiments[start:end]))
+        # the last entry is the whole document
+        results.append((list(chain.from_iterable(document)), s24_sentiment.document_sentiment(document_features)))
+        retval.append({'sentiment': results})
+        start = end
+    return retval
+
+def sentiment_batch(texts, args):
+    return batched(texts, sentiment_documents)
+
+def annotate_documents(texts):
+    documents = tokenize_documents(texts)
+    return split_documents(documents, annotate_sentences(list(chain.from_iterable(documents))))
+
+def annotate_batch(texts, args):
+    return batched(texts, annotate_documents)
+
+def read_batch():
+    """Return the ids and texts of a batch request, which is either a json
+    array or ndjson of {"id": ..., "text": ...} objects."""
     data = request.get_data(as_text = True)
-    temporary_conllu_file = NamedTemporaryFile(suffix = ".conllu")
-    temporary_conllu_file.write(data.encode('utf-8'))
-    temporary_conllu_file.flush()
-    process = Popen(["conllu2svg", temporary_conllu_file.name], encoding = "utf-8", stdin = PIPE, stdout = PIPE)
-    out, err = process.communicate()
-    return out
+    if request.mimetype == 'application/x-ndjson':
+        documents = [json.loads(line) for line in data.split('\n') if line.strip() != '']
+    else:
+        documents = json.loads(data)
+    return [document['id'] for document in documents], [document['text'] for document in documents]
+
+# <path>/batch endpoints process many documents in one request. Documents
+# are grouped into chunks like those of a long text, and the documents of a
+# chunk share its tokenizer and tagger runs and the sentiment model's batches.
+# The results are {"id": ..., "result": ...} objects in the order given, as a
+# json array, or as ndjson if that's what was posted.
+batch_tools = {
+    'postag': ('/text/fi/postag', postag_batch),
+    'nertag': ('/text/fi/nertag', nertag_batch),
+    'sentiment': ('/text/fi/sentiment', sentiment_batch),
+    'annotate': ('/text/fi/annotate', annotate_batch),
+}
+
+def make_batch_route(function):
+    def route_batch():
+        try:
+            ids, texts = read_batch()
+        except (ValueError, TypeError, KeyError):
+            return jsonify({'error': 'expected a json array or ndjson of objects with id and text'}), 400
+        if any(DOCUMENT_SEPARATOR in text for text in texts):
+            return jsonify({'error': "documents may not contain " + DOCUMENT_SEPARATOR}), 400
+        try:
+            batch_results = function(texts, request.args.to_dict())
+        except SeparatorInText:
+            return jsonify({'error': "documents may not contain " + DOCUMENT_SEPARATOR}), 400
+        results = [{'id': _id, 'result': result} for _id, result in zip(ids, batch_results)]
+        if request.mimetype == 'application/x-ndjson':
+            return ndjson_response(results)
+        return jsonify(results)
+    return route_batch
+
+for tool, (path, function) in batch_tools.items():
+    app.add_url_rule(path + '/batch', tool + '_batch', make_batch_route(function), methods=['POST'])
 
 @app.route('/text/fi/health', methods=['GET'])
 def route_health():
@@ -187,6 +595,8 @@ def route_health():
         pass
     return jsonify(response)
 
+metrics.add_route(app, 'texttools')
+
 @app.route('/text/fi/self_test', methods=["GET"])
 def route_self_test():
     response = {"status": "UP",
@@ -0,0 +1,50 @@
+import json
+import hashlib
+import logging
+import redis
+
+class SentenceCache:
+    """Per-sentence results of the text tools, in a redis of their own.
+
+    Keys are made of the tool, its arguments, the tool's model version and a
+    hash of the tokenized sentence, so a document that shares sentences with
+    earlier input only needs the new ones processed. The cache redis is
+    configured to evict least recently used keys when it's full, which
+    keeps it from competing with job records for memory.
+
+    If the cache is unreachable, everything is a miss."""
+
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+
+    def key(self, tool, version, args, sentence):
+        digest = hashlib.sha1('\n'.join(sentence).encode('utf-8')).hexdigest()
+        return '{}:{}:{}:{}'.format(tool, version, json.dumps(args, sort_keys = True), digest)
+
+    def lookup(self, tool, version, args, sentences, compute,
+               encode = lambda result: json.dumps(result).encode('utf-8'),
+               decode = json.loads):
+        """Return compute(sentences), calling compute only on the sentences
+        that aren't in the cache. compute must return one result per sentence."""
+        if len(sentences) == 0:
+            return []
+        keys = [self.key(tool, version, args, sentence) for sentence in sentences]
+        try:
+            cached = self.redis_conn.mget(keys)
+        except redis.exceptions.RedisError as ex:
+            logging.warning("sentence cache unavailable: " + str(ex))
+            return compute(sentences)
+        missing = [i for i, value in enumerate(cached) if value is None]
+        results = [None if value is None else decode(value) for value in cached]
+        if len(missing) == 0:
+            return results
+        computed = compute([sentences[i] for i in missing])
+        if len(computed) != len(missing):
+            raise RuntimeError("{} returned {} sentences for {}".format(tool, len(computed), len(missing)))
+        for i, result in zip(missing, computed):
+            results[i] = result
+        try:
+            self.redis_conn.mset({keys[i]: encode(result) for i, result in zip(missing, computed)})
+        except redis.exceptions.RedisError as ex:
+            logging.warning("sentence cache unavailable: " + str(ex))
+        return results
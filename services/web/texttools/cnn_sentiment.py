@@ -1,12 +1,26 @@
 import os, sys
+import hashlib
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
-from . import embutils
+from .embedding_table import EmbeddingTable
 
 _dir = os.path.dirname(os.path.abspath(__file__))
 
+# torch.inference_mode appeared in torch 1.9, older versions only have no_grad
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+# Sentences are classified concurrently by the request and tagger threads, so
+# by default each classification runs in one thread rather than in a pool per
+# worker sized for the whole machine
+torch.set_num_threads(int(os.environ.get('SENTIMENT_THREADS', 1)))
+
+# With SENTIMENT_QUANTIZED=true the model runs with int8 weights, see
+# CNN_Text.quantize. Check a model with test/sentiment_parity.py before
+# turning this on.
+QUANTIZED = os.environ.get('SENTIMENT_QUANTIZED', '').lower() == 'true'
+
 class Args:
     def __init__(self, model):
         if model == "s24":
@@ -20,6 +34,7 @@ class Args:
             self.cuda = False
             self.kernel_sizes = [2,3,4,5]
             self.snapshot = os.path.join(_dir, 's24_sentiment/final_model.pt')
+            self.embeddings = os.path.join(_dir, 's24_sentiment/s24_surface_vecs')
             self.kernel_num = 100
             self.device = -1
             self.static=True
@@ -29,9 +44,9 @@ class CNN_Text(nn.Module):
     def __init__(self, args):
         super(CNN_Text, self).__init__()
         self.args = args
-        self.embs = embutils.WordEmbeddings()
-        self.embs.load_from_file(os.path.join(_dir,
-                                              "s24_sentiment/s24_surface_vecs.bin"))
+        # converted from s24_surface_vecs.bin at image build time,
+        # see embedding_table.py
+        self.embs = EmbeddingTable(args.embeddings)
 
         self.steps = 0
         
@@ -49,39 +64,74 @@ class CNN_Text(nn.Module):
         '''
         self.dropout = nn.Dropout(args.dropout)
         self.fc1 = nn.Linear(len(Ks)*Co, C)
+        # the convolutions as Linear layers, see quantize
+        self.window_linears = None
+
+    def quantize(self):
+        """Switch to inference with int8 weights. Dynamic quantization only
+        applies to Linear layers, so each convolution, which spans the whole
+        embedding, is re-expressed as a Linear layer over the windows of K
+        embeddings, and those and fc1 are quantized.
+
+        Dynamic quantization scales the activations by the range of each
+        input, so features then computes each sentence in a batch of its own,
+        to keep its features independent of the rest of the batch."""
+        self.window_linears = nn.ModuleList()
+        for conv in self.convs1:
+            Co, Ci, K, D = conv.weight.shape
+            linear = nn.Linear(Ci * K * D, Co)
+            linear.weight.data = conv.weight.data.reshape(Co, Ci * K * D).clone()
+            linear.bias.data = conv.bias.data.clone()
+            self.window_linears.append(linear)
+        torch.quantization.quantize_dynamic(self, {nn.Linear}, dtype = torch.qint8, inplace = True)
+
+    def token_rows(self, texts, width):
+        """Return a (N, width) array of embedding table rows, padded with row 0."""
+        rows = np.zeros((len(texts), width), dtype=np.int64)
+        for i, text in enumerate(texts):
+            rows[i, :len(text)] = [self.embs.lookup(token) for token in text]
+        return rows
 
     def embed(self, texts):
-        veclists = []
-        for text in texts:
-            veclists.append([])
-            for token in text:
-                emb = self.embs.get_embedding(token)
-                veclists[-1].append(emb[1])
-        def pad(veclist, to, padding):
-            while len(veclist) < to:
-                veclist.append(padding)
         maxlen = max(max(map(len, texts)), max(self.args.kernel_sizes))
-        padding = [0.0] * self.args.embed_dim
-        for veclist in veclists:
-            pad(veclist, maxlen, padding)
-        return torch.Tensor(veclists)
+        return torch.from_numpy(self.embs.gather(self.token_rows(texts, maxlen)))  # (N, W, D)
         
+    def window_mask(self, texts, K, windows):
+        """Return a (N, windows) mask of the windows of K tokens that start
+        past the end of each text, or past the first window for texts shorter
+        than K, so that padding doesn't depend on the rest of the batch."""
+        last = torch.tensor([max(len(text), K) - K for text in texts])
+        return torch.arange(windows).unsqueeze(0) > last.unsqueeze(1)
+
     def conv_and_pool(self, x, conv):
         x = F.relu(conv(x)).squeeze(3)  # (N, Co, W)
         x = F.max_pool1d(x, x.size(2)).squeeze(2)
         return x
 
-    def forward(self, x):
-        x = list(x)
-        x = self.embed(x)  # (N, W, D)
-        
-        if self.args.static:
-            x = Variable(x)
+    def quantized_features(self, text):
+        """Return the (1, len(Ks)*Co) features of one text with the int8 model."""
+        x = self.embed([text])  # (1, W, D)
+        # (1, W-K+1, K*D) windows through each Linear, max pooled
+        pooled = []
+        for K, linear in zip(self.args.kernel_sizes, self.window_linears):
+            y = F.relu(linear(x.unfold(1, K, 1).transpose(2, 3).flatten(2)))  # (1, W-K+1, Co)
+            y = y.masked_fill(self.window_mask([text], K, y.size(1)).unsqueeze(2), float('-inf'))
+            pooled.append(y.max(dim=1)[0])
+        return torch.cat(pooled, 1)
 
+    def features(self, x):
+        texts = list(x)
+        if self.window_linears is not None:
+            return torch.cat([self.quantized_features(text) for text in texts])
+
+        x = self.embed(texts)  # (N, W, D)
         x = x.unsqueeze(1)  # (N, Ci, W, D)
 
         x = [F.relu(conv(x)).squeeze(3) for conv in self.convs1]  # [(N, Co, W), ...]*len(Ks)
 
+        x = [i.masked_fill(self.window_mask(texts, K, i.size(2)).unsqueeze(1), float('-inf'))
+             for K, i in zip(self.args.kernel_sizes, x)]
+
         x = [F.max_pool1d(i, i.size(2)).squeeze(2) for i in x]  # [(N, Co), ...]*len(Ks)
 
         x = torch.cat(x, 1)
@@ -92,22 +142,88 @@ class CNN_Text(nn.Module):
         x3 = self.conv_and_pool(x,self.conv15) #(N,Co)
         x = torch.cat((x1, x2, x3), 1) # (N,len(Ks)*Co)
         '''
+        return x
+
+    def classify(self, x):
         x = self.dropout(x)  # (N, len(Ks)*Co)
         #logit = torch.squeeze(self.fc1(x))  # (N, 1)
         logit = self.fc1(x)  # (N, C)
         return logit
 
-    def list(self, inputs):
+    def forward(self, x):
+        return self.classify(self.features(x))
+
+    def length_buckets(self, inputs):
+        """Yield lists of indices into inputs, at most batch_size long, whose
+        lengths are within a factor of two of each other, so that little of
+        each batch is padding."""
+        order = sorted(range(len(inputs)), key=lambda i: len(inputs[i]))
+        bucket = []
+        for i in order:
+            if len(bucket) > 0 and (len(bucket) == self.args.batch_size or
+                                    len(inputs[i]) > 2 * max(len(inputs[bucket[0]]), max(self.args.kernel_sizes))):
+                yield bucket
+                bucket = []
+            bucket.append(i)
+        if len(bucket) > 0:
+            yield bucket
+
+    def batched_features(self, inputs):
+        features = torch.empty(len(inputs), len(self.args.kernel_sizes) * self.args.kernel_num)
+        for bucket in self.length_buckets(inputs):
+            features[bucket] = self.features([inputs[i] for i in bucket])
+        return features
+
+    def labels(self, logits):
         preds = ["neg", "neut", "pos"]
-        retval = []
-        for i, prediction in enumerate(self(inputs)):
-            retval.append(preds[torch.argmax(prediction)])
-        return retval
+        return [preds[prediction] for prediction in torch.argmax(logits, dim=1).tolist()]
+
+    def sentence_features(self, sentences):
+        """Return the pooled features of each sentence as a float32 array."""
+        with inference_mode():
+            return self.batched_features(sentences).numpy()
+
+    def list(self, inputs, features = None):
+        if len(inputs) == 0:
+            return []
+        with inference_mode():
+            if features is None:
+                features = self.batched_features(inputs)
+            else:
+                features = torch.from_numpy(features)
+            return self.labels(self.classify(features))
+
+    def document_sentiment(self, document_features):
+        """Return the sentiment label of a document given the elementwise
+        maximum of its sentences' features, which is None for an empty
+        document."""
+        with inference_mode():
+            if document_features is None:
+                features = self.batched_features([[]])
+            else:
+                features = torch.from_numpy(document_features).unsqueeze(0)
+            return self.labels(self.classify(features))[0]
 
     def txt(self, inputs):
         return '\n'.join(self.list(inputs))
 
+# part of the sentence cache keys along with the model's hash, bump it when
+# the features computed for a sentence change
+FEATURES_VERSION = 2
+# likewise for the features of the int8 model
+QUANTIZED_FEATURES_VERSION = 2
+
+def load(args, quantized = False):
+    model = CNN_Text(args)
+    model.load_state_dict(torch.load(args.snapshot))
+    model.eval()
+    with open(args.snapshot, 'rb') as snapshot:
+        model.version = '{}.{}'.format(hashlib.sha1(snapshot.read()).hexdigest()[:12], FEATURES_VERSION)
+    if quantized:
+        model.quantize()
+        # int8 features were computed per batch before version 2 of them
+        model.version += '-int8.{}'.format(QUANTIZED_FEATURES_VERSION)
+    return model
+
 s24_args = Args("s24")
-s24 = CNN_Text(s24_args)
-s24.load_state_dict(torch.load(s24_args.snapshot))
-s24.eval()
+s24 = load(s24_args, QUANTIZED)
@@ -0,0 +1,147 @@
+"""Memory-mapped word embedding table.
+
+The table is a directory containing
+
+    vectors.npy   float32 matrix, row 0 is all zeros (padding and unknown words)
+    vocab.bin     the vocabulary as concatenated utf-8, sorted bytewise
+    offsets.npy   int64 offsets of each word in vocab.bin, plus the end offset
+    rows.npy      int32 row in vectors.npy of each word, in vocab.bin order
+
+Everything is opened with mmap, so all processes loading the same table share
+one copy in the page cache. Convert a word2vec binary file with
+
+    python3 embedding_table.py vectors.bin table_directory
+
+Unknown words get the zero vector. To check that the table gives the same
+vectors as the embutils module it replaces, for a sample of known words, their
+case variants and unknown words, run with embutils on the python path
+
+    python3 embedding_table.py --check vectors.bin table_directory
+
+This file is run as a script at image build time, so it doesn't import
+anything from the package."""
+
+import os, sys
+import mmap
+import functools
+import numpy as np
+
+class EmbeddingTable:
+    def __init__(self, path, cache_size = 2**18):
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode = 'r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode = 'r')
+        self.rows = np.load(os.path.join(path, 'rows.npy'), mmap_mode = 'r')
+        with open(os.path.join(path, 'vocab.bin'), 'rb') as vocab_file:
+            self.vocab = mmap.mmap(vocab_file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.dim = self.vectors.shape[1]
+        # Zipf's law makes a per-process memo of the binary search worthwhile
+        self.lookup = functools.lru_cache(maxsize = cache_size)(self._lookup)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def word(self, i):
+        return self.vocab[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def _lookup(self, token):
+        """Return the row of token in self.vectors, or 0 if it's unknown."""
+        key = token.encode('utf-8')
+        lo, hi = 0, len(self.rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.word(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.rows) and self.word(lo) == key:
+            return int(self.rows[lo])
+        return 0
+
+    def gather(self, rows):
+        """Return the vectors for an integer array of rows, in a new array."""
+        return np.take(self.vectors, rows, axis = 0)
+
+def read_header(f):
+    """Return the number of words and the dimension from a word2vec binary
+    file's header, or raise ValueError if it doesn't look like one."""
+    header = f.readline().split()
+    if len(header) != 2 or not all(field.isdigit() for field in header):
+        raise ValueError("not a word2vec binary file: header {!r}".format(b' '.join(header)))
+    return int(header[0]), int(header[1])
+
+def read_word2vec_bin(path):
+    """Yield (word as bytes, float32 vector) pairs from a word2vec binary file.
+    Raise ValueError if the file ends early or has data after the last
+    vector."""
+    with open(path, 'rb') as f:
+        n_words, dim = read_header(f)
+        vector_bytes = 4 * dim
+        for i in range(n_words):
+            word = bytearray()
+            while True:
+                c = f.read(1)
+                if c == b' ' or c == b'':
+                    break
+                if c != b'\n':
+                    word += c
+            data = f.read(vector_bytes)
+            if not word or len(data) != vector_bytes:
+                raise ValueError("word2vec binary file ended at word {} of {}".format(i, n_words))
+            yield bytes(word), np.frombuffer(data, dtype = '<f4')
+        if f.read().strip():
+            raise ValueError("data after {} words in word2vec binary file".format(n_words))
+
+def convert(source, path):
+    with open(source, 'rb') as f:
+        n_words, dim = read_header(f)
+    os.makedirs(path, exist_ok = True)
+    vectors = np.lib.format.open_memmap(os.path.join(path, 'vectors.npy'), mode = 'w+',
+                                        dtype = np.float32, shape = (n_words + 1, dim))
+    vectors[0] = 0.0
+    words = {}
+    for row, (word, vector) in enumerate(read_word2vec_bin(source), start = 1):
+        vectors[row] = vector
+        words.setdefault(word, row)
+    vectors.flush()
+    del vectors
+    sorted_words = sorted(words)
+    offsets = np.zeros(len(sorted_words) + 1, dtype = np.int64)
+    with open(os.path.join(path, 'vocab.bin'), 'wb') as vocab_file:
+        for i, word in enumerate(sorted_words):
+            vocab_file.write(word)
+            offsets[i + 1] = offsets[i] + len(word)
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+    np.save(os.path.join(path, 'rows.npy'),
+            np.array([words[word] for word in sorted_words], dtype = np.int32))
+
+# not in the vocabulary, or at least not all of them
+UNKNOWN_SAMPLE = ['', ' ', 'xqzvwjkx', 'Xqzvwjkx', '1234567890', '3,14', '!!!', '...', ':-)',
+                  'kissa.', '"kissa', 'http://example.com', 'ÄÄLIÖMÄISYYS', 'šakki', '\u00e4\u0308']
+
+def check(source, path, every = 1000):
+    """Compare the table's vectors with embutils' for a sample of words.
+    Return the number of differences, which are printed."""
+    import embutils
+    embs = embutils.WordEmbeddings()
+    embs.load_from_file(source)
+    table = EmbeddingTable(path)
+    sample = list(UNKNOWN_SAMPLE)
+    for i in range(0, len(table), every):
+        word = table.word(i).decode('utf-8', errors = 'replace')
+        sample += [word, word.lower(), word.upper(), word.capitalize()]
+    differences = 0
+    for token in sample:
+        expected = np.asarray(embs.get_embedding(token)[1], dtype = np.float32)
+        got = table.vectors[table.lookup(token)]
+        if expected.shape != got.shape or not np.allclose(expected, got, atol = 1e-6):
+            differences += 1
+            print("{!r}: embutils {} table {}".format(token, expected[:4], got[:4]))
+    print("{} of {} tokens differ".format(differences, len(sample)))
+    return differences
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--check':
+        sys.exit(1 if check(sys.argv[2], sys.argv[3]) else 0)
+    if len(sys.argv) != 3:
+        sys.exit("usage: {} [--check] word2vec_bin_file table_directory".format(sys.argv[0]))
+    convert(sys.argv[1], sys.argv[2])
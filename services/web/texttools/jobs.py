@@ -0,0 +1,208 @@
+import os
+import time
+import uuid
+import json
+import signal
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from servicecommon import jobwait
+from servicecommon import metrics
+
+# REDIS DATA MODEL
+# ----------------
+# As in kaldi-serve, jobids are UUID strings used as redis keys, and the
+# values are redis hashes. The following fields should ALWAYS be present:
+#
+# 1) type (the tool, eg. postag, ner, sentiment)
+# 2) status (pending, done, error, cancelled)
+# 3) processing_started (unix timestamp)
+#
+# Additionally, once the job has finished, the hash has
+#
+# 4) processing_finished
+# 5) error (message, if status is error)
+# 6) timing:<stage> (seconds spent in each stage, see
+#    servicecommon/metrics.py). The stages are queue_wait, and tokenize, tag
+#    and sentiment summed over the chunks of the text.
+#
+# The result (what the corresponding synchronous endpoint returns) is stored
+# through the PayloadStore, see servicecommon/payloads.py. Jobs from before
+# that have it in the hash.
+
+class Cancelled(Exception):
+    pass
+
+class RunningJob:
+    """A job being run, and the tool processes it has running."""
+
+    def __init__(self, _id):
+        self.id = _id
+        self.cancelled = False
+        self.processes = set()
+        self.lock = threading.Lock()
+
+    def started(self, process):
+        with self.lock:
+            self.processes.add(process)
+            if self.cancelled:
+                kill(process)
+
+    def finished(self, process):
+        """Forget a finished process, and raise Cancelled if the job has
+        been cancelled, as the output may be cut short."""
+        with self.lock:
+            self.processes.discard(process)
+        if self.cancelled:
+            raise Cancelled()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for process in self.processes:
+                kill(process)
+
+def kill(process):
+    """Kill a process started with start_new_session, and its children."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+# The job the current thread is working on, if any
+local = threading.local()
+
+def current_job():
+    return getattr(local, 'job', None)
+
+def bind(function):
+    """Return function wrapped to run as part of the calling thread's job,
+    and add to its Timings, wherever it runs."""
+    job = current_job()
+    function = metrics.bind(function)
+    def bound(*args, **kwargs):
+        previous = current_job()
+        local.job = job
+        try:
+            return function(*args, **kwargs)
+        finally:
+            local.job = previous
+    return bound
+
+class JobQueue:
+    """Runs submitted jobs on a bounded pool of worker threads and commits
+    their results to redis.
+
+    At most max_queued jobs may be waiting or running at a time, further
+    submissions are refused rather than queued without limit."""
+
+    def __init__(self, redis_conn, payloads, expiry_time, max_workers, max_queued):
+        self.redis_conn = redis_conn
+        self.payloads = payloads
+        self.expiry_time = expiry_time
+        self.max_queued = max_queued
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+        self.queued = 0
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def submit(self, job_type, function, *args):
+        """Return the jobid of the new job, or None if the queue is full."""
+        with self.lock:
+            if self.queued >= self.max_queued:
+                return None
+            self.queued += 1
+        _id = str(uuid.uuid4())
+        submitted = round(time.time(), 3)
+        try:
+            self.redis_conn.hset(_id, mapping = {'type': job_type, 'status': 'pending',
+                                                 'processing_started': submitted})
+            self.redis_conn.expire(_id, self.expiry_time)
+            self.executor.submit(self.run_and_commit, _id, function, args, submitted)
+        except Exception:
+            # run_and_commit won't be there to give the place back
+            with self.lock:
+                self.queued -= 1
+            raise
+        return _id
+
+    def run_and_commit(self, _id, function, args, submitted):
+        job = RunningJob(_id)
+        with self.lock:
+            self.running[_id] = job
+        try:
+            # cancelled jobs are dropped before they start
+            if self.redis_conn.hget(_id, 'status') != 'pending':
+                return
+            local.job = job
+            with metrics.collecting(metrics.Timings()):
+                metrics.record('queue_wait', time.time() - submitted)
+                try:
+                    result = function(*args)
+                    if job.cancelled:
+                        return
+                    self.payloads.put(_id, 'result', result)
+                    redis_entry = {'status': 'done'}
+                except Cancelled:
+                    return
+                except Exception as ex:
+                    logging.error("job {} failed: {}".format(_id, ex))
+                    redis_entry = {'status': 'error', 'error': str(ex)}
+                redis_entry.update(metrics.fields())
+            redis_entry['processing_finished'] = round(time.time(), 3)
+            # not if the job has been cancelled or has expired meanwhile
+            jobwait.finish(self.redis_conn, _id, redis_entry)
+        finally:
+            local.job = None
+            with self.lock:
+                self.queued -= 1
+                del self.running[_id]
+
+    def cancel(self, _id, job_type):
+        """Cancel a pending job. A job that hasn't started is dropped, and the
+        tool processes of a running one are killed."""
+        redis_hash = self.redis_conn.hgetall(_id)
+        if redis_hash.get('type') != job_type:
+            return {'error': 'job id not available'}
+        status = redis_hash.get('status')
+        if status == 'pending':
+            if jobwait.finish(self.redis_conn, _id, {'status': 'cancelled',
+                                                     'processing_finished': round(time.time(), 3)}):
+                status = 'cancelled'
+                with self.lock:
+                    job = self.running.get(_id)
+                if job is not None:
+                    job.cancel()
+            else:
+                # the job finished first
+                status = self.redis_conn.hget(_id, 'status')
+        return {'jobid': _id, 'status': status}
+
+    def query(self, _id, job_type, wait = 0, timings = False):
+        """Return the job as a dict suitable for a query_job response, after
+        waiting up to wait seconds for it to finish. With timings, the
+        response includes the seconds spent in each stage."""
+        jobwait.wait_for(self.redis_conn, _id,
+                         lambda: self.redis_conn.hget(_id, 'status') == 'pending', wait)
+        if _id not in self.redis_conn:
+            return {'error': 'job id not available'}
+        response = self.redis_conn.hgetall(_id)
+        if response.get('type') != job_type:
+            return {'error': 'job id not available'}
+        if response.get('status') == 'pending':
+            return {'status': 'pending'}
+        if response.get('status') == 'cancelled':
+            return {'status': 'cancelled'}
+        response.pop('type', None)
+        stage_timings = metrics.pop_timings(response)
+        if timings:
+            response['timings'] = stage_timings
+        if 'result' in response:
+            response['result'] = json.loads(response['result'])
+        elif response.get('status') == 'done':
+            response['result'] = self.payloads.get(_id, 'result')
+            if response['result'] is None:
+                return {'error': 'job result not available'}
+        response['processing_started'] = float(response.get('processing_started'))
+        response['processing_finished'] = float(response.get('processing_finished'))
+        return response
@@ -0,0 +1,118 @@
+"""In-process morphological analysis for the postag pipeline.
+
+finnish-postag runs every token through the omorfi transducer before FinnPos
+picks one analysis. Word forms follow Zipf's law, so most tokens are forms
+that have been seen many times already. Here the transducer is loaded once
+and its lookups are memoized per word form. Only the lookup is replaced: its
+output, in the format of hfst-optimized-lookup, is fed to the rest of
+finnish-postag's own pipeline, which computes FinnPos's features, labels
+and restores the lemmas as finnish-postag does.
+
+This is off unless POSTAG_IN_PROCESS=true. It then needs the hfst bindings
+built into the web image, OMORFI_TRANSDUCER, the transducer finnish-postag
+looks tokens up in, and POSTAG_AFTER_LOOKUP, the shell pipeline that
+finnish-postag runs on the lookup output. Both depend on the installed
+finnish-tagtools, so they have no defaults; the web image sets them for the
+finnish-tagtools it installs. Check the configuration by tagging some text,
+one sentence per line, both ways with
+
+    python3 morphology.py --check < sentences.txt
+
+which the image build does, or test/postag_parity.py, which goes through the
+postag endpoint's code with a larger corpus.
+
+This file is run as a script at image build time, so it doesn't import
+anything from the package."""
+
+import os
+import sys
+import functools
+import subprocess
+try:
+    import hfst
+except ImportError:
+    hfst = None
+
+ENABLED = os.environ.get('POSTAG_IN_PROCESS', '').lower() == 'true'
+OMORFI_TRANSDUCER = os.environ.get('OMORFI_TRANSDUCER')
+POSTAG_AFTER_LOOKUP = os.environ.get('POSTAG_AFTER_LOOKUP')
+MORPHOLOGY_CACHE_SIZE = int(os.environ.get('MORPHOLOGY_CACHE_SIZE', 2**18))
+
+def available():
+    """Return whether postag should use the Analyser. Raises RuntimeError if
+    it's enabled but can't be used, rather than silently tagging differently."""
+    if not ENABLED:
+        return False
+    if hfst is None:
+        raise RuntimeError("POSTAG_IN_PROCESS needs the hfst python bindings")
+    if OMORFI_TRANSDUCER is None or not os.path.isfile(OMORFI_TRANSDUCER):
+        raise RuntimeError("POSTAG_IN_PROCESS needs OMORFI_TRANSDUCER to name the transducer file")
+    if not POSTAG_AFTER_LOOKUP:
+        raise RuntimeError("POSTAG_IN_PROCESS needs POSTAG_AFTER_LOOKUP")
+    return True
+
+def after_lookup_args():
+    return ["sh", "-c", POSTAG_AFTER_LOOKUP]
+
+class Analyser:
+    def __init__(self, path = OMORFI_TRANSDUCER, cache_size = MORPHOLOGY_CACHE_SIZE):
+        stream = hfst.HfstInputStream(path)
+        self.transducer = stream.read()
+        stream.close()
+        self.lookup = functools.lru_cache(maxsize = cache_size)(self._lookup)
+
+    def _lookup(self, word):
+        """Return the lines hfst-optimized-lookup prints for word: one per
+        analysis, or word+? with infinite weight if there are none."""
+        analyses = self.transducer.lookup(word)
+        if len(analyses) == 0:
+            return '{}\t{}+?\tinf\n'.format(word, word)
+        return ''.join('{}\t{}\t{:f}\n'.format(word, analysis, weight)
+                       for analysis, weight in analyses)
+
+    def lookup_output(self, sentences):
+        """Return what the transducer lookup in finnish-postag outputs for
+        tokenized sentences, which are separated by an empty line in its
+        input. hfst-optimized-lookup has no special case for empty lines, it
+        looks up the empty string like any other token and prints it as
+        unknown, \\t+?\\tinf, and that is what ends a sentence for the rest
+        of the pipeline."""
+        lines = []
+        for i, sentence in enumerate(sentences):
+            if i > 0:
+                lines.append(self.lookup('') + '\n')
+            for token in sentence:
+                lines.append(self.lookup(token) + '\n')
+        return ''.join(lines)
+
+def run(process_args, data):
+    return subprocess.run(process_args, input = data, stdout = subprocess.PIPE,
+                          encoding = 'utf-8', check = True).stdout
+
+def sentences_of(out):
+    blocks = ([line for line in block.split('\n') if line.strip() != '']
+              for block in out.split('\n\n'))
+    return [block for block in blocks if len(block) > 0]
+
+def check(text):
+    """Tag text with finnish-postag and with the Analyser followed by
+    POSTAG_AFTER_LOOKUP. Return the number of sentences tagged differently,
+    which are printed."""
+    sentences = sentences_of(run(["finnish-tokenize"], text))
+    tokenized = ''.join('\n'.join(sentence) + '\n\n' for sentence in sentences)
+    expected = sentences_of(run(["finnish-postag", "--no-tokenize"], tokenized))
+    got = sentences_of(run(after_lookup_args(), Analyser().lookup_output(sentences)))
+    differences = abs(len(expected) - len(got))
+    for e, g in zip(expected, got):
+        if e != g:
+            differences += 1
+            print("finnish-postag {}\nin process      {}".format(e, g))
+    print("{} of {} sentences differ".format(differences, len(expected)))
+    return differences
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] != '--check':
+        sys.exit("usage: {} --check < sentences.txt".format(sys.argv[0]))
+    if not available():
+        sys.exit("POSTAG_IN_PROCESS isn't enabled")
+    sys.exit(1 if check(sys.stdin.read()) else 0)
@@ -0,0 +1,331 @@
+"""Offline benchmark of the kaldi-serve pipeline.
+
+Imports services/kaldi-serve/server.py with the kaldiserve module replaced by
+test/stubs/kaldiserve.py, whose decoding costs a configurable real-time
+factor, and runs synthetic audio through submit_file and query_job with the
+Flask test client. Segment re-submissions go to the test client as well, so
+no network or Kaldi is needed, only redis (or fakeredis with --redis fake).
+
+The output is one json document with per-stage wall times, peak RSS,
+throughput in audio seconds per second and job latency percentiles, for
+comparing between releases. Eg.
+
+    python bench_asr.py --durations 30,120,600 --repeats 5 --output ../bench_output.txt
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(TEST_DIR, "..", "services", "kaldi-serve")
+COMMON_DIR = os.path.join(TEST_DIR, "..", "services", "common")
+
+parser = argparse.ArgumentParser(description="Benchmark the asr pipeline offline")
+parser.add_argument(
+    "--durations", default="30,120", help="comma-separated audio lengths in seconds"
+)
+parser.add_argument(
+    "--kinds",
+    default="speech,pattern",
+    help="speech: irregular bursts and pauses, pattern: 1 s bursts every 1.4 s",
+)
+parser.add_argument("--repeats", type=int, default=3)
+parser.add_argument("--concurrency", type=int, default=1)
+parser.add_argument("--nosplit", action="store_true")
+parser.add_argument(
+    "--sample-rate",
+    type=int,
+    default=16000,
+    help="anything but 16000 exercises resampling, which needs ffmpeg",
+)
+parser.add_argument(
+    "--format", default="wav", help="formats other than wav need ffmpeg"
+)
+parser.add_argument("--rtf", type=float, default=0.05, help="stub decoder cost")
+parser.add_argument("--overhead", type=float, default=0.01, help="stub decoder cost")
+parser.add_argument(
+    "--redis", default="fake", help="'fake' for fakeredis, or a redis host"
+)
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--output", help="write the json here as well as to stdout")
+args = parser.parse_args()
+if args.output:
+    args.output = os.path.abspath(args.output)
+
+
+class Stages:
+    """Wall time per stage. Nested stages are subtracted from their caller's
+    self time, which is how the merging in submit_segments() shows up on its own."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.times = {}
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.times.setdefault(stage, []).append(seconds)
+
+    def timed(self, stage, function, self_stage=None):
+        def wrapper(*a, **kw):
+            stack = self.local.__dict__.setdefault("stack", [])
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return function(*a, **kw)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                self.record(stage, elapsed)
+                if self_stage:
+                    self.record(self_stage, elapsed - nested)
+
+        return wrapper
+
+    def summary(self):
+        with self.lock:
+            return {
+                stage: dict(calls=len(times), **percentiles(times, total=True))
+                for stage, times in sorted(self.times.items())
+            }
+
+
+def percentiles(values, total=False):
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {
+        "mean": round(sum(values) / len(values), 6),
+        "p50": round(values[int(0.5 * (len(values) - 1))], 6),
+        "p95": round(values[int(0.95 * (len(values) - 1))], 6),
+        "max": round(values[-1], 6),
+    }
+    if total:
+        result["total"] = round(sum(values), 6)
+    return result
+
+
+class TimedLock:
+    def __init__(self, lock):
+        self.lock = lock
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        stages.record("lock_wait", time.perf_counter() - start)
+
+    def release(self):
+        self.lock.release()
+
+
+class TestClientResponse:
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.text = response.get_data(as_text=True)
+
+
+stages = Stages()
+
+
+def load_server(workdir):
+    """Import the kaldi-serve server module with the stub decoder and
+    instrumented stages."""
+    os.environ["KALDISERVE_STUB_RTF"] = str(args.rtf)
+    os.environ["KALDISERVE_STUB_OVERHEAD"] = str(args.overhead)
+    os.environ["PAYLOAD_DIR"] = os.path.join(workdir, "payloads")
+    os.environ["UPLOAD_DIR"] = os.path.join(workdir, "uploads")
+    sys.path[:0] = [os.path.join(TEST_DIR, "stubs"), SERVER_DIR, COMMON_DIR]
+
+    import redis
+
+    if args.redis == "fake":
+        import fakeredis
+
+        fake_server = fakeredis.FakeServer()
+
+        class Redis(fakeredis.FakeRedis):
+            def __init__(self, **kw):
+                super().__init__(server=fake_server, **kw)
+
+    else:
+
+        class Redis(redis.Redis):
+            def __init__(self, **kw):
+                kw["host"] = args.redis
+                super().__init__(**kw)
+
+    Redis.execute_command = stages.timed("redis", Redis.execute_command)
+    redis.Redis = Redis
+
+    with open(os.path.join(workdir, "model-spec.toml"), "w") as f:
+        f.write('[[model]]\nname = "stub"\nlanguage_code = "fi"\npath = "."\n')
+    os.chdir(workdir)
+
+    import pydub
+    import pydub.silence
+    import requests
+
+    pydub.AudioSegment.from_file = staticmethod(
+        stages.timed("from_file", pydub.AudioSegment.from_file)
+    )
+    pydub.AudioSegment.export = stages.timed("export", pydub.AudioSegment.export)
+    pydub.silence.split_on_silence = stages.timed(
+        "split_on_silence", pydub.silence.split_on_silence
+    )
+    subprocess.run = stages.timed("resample", subprocess.run)
+
+    import server
+
+    client = server.app.test_client()
+
+    def post(url, data=None, params=None, **kw):
+        path = url[url.index("/audio/") :]
+        return TestClientResponse(client.post(path, data=data, query_string=params))
+
+    requests.post = stages.timed("resubmit", post)
+    server.segmented = stages.timed("segmented", server.segmented, "merge")
+    server.decode_and_commit = stages.timed(
+        "decode_and_commit", server.decode_and_commit, "commit"
+    )
+    server.decoder.decode_wav_audio = stages.timed(
+        "decode", server.decoder.decode_wav_audio
+    )
+    server.decoder_lock = TimedLock(server.decoder_lock)
+    return server
+
+
+def synthetic_audio(kind, duration, rng):
+    """Return int16 samples of voiced bursts separated by near-silence."""
+    rate = args.sample_rate
+    samples = np.zeros(int(duration * rate), dtype=np.float32)
+    noise = np.random.default_rng(rng.randrange(2 ** 32))
+    position = 0.0
+    while position < duration:
+        if kind == "pattern":
+            burst, pause = 1.0, 0.4
+        else:
+            burst, pause = rng.uniform(0.3, 2.5), rng.uniform(0.1, 1.2)
+        start, end = int(position * rate), int(min(position + burst, duration) * rate)
+        t = np.arange(end - start, dtype=np.float32) / rate
+        f0 = rng.uniform(90, 250)
+        voiced = sum(np.sin(2 * np.pi * f0 * h * t) / h for h in (1, 2, 3))
+        # syllable-rate envelope
+        voiced *= 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(3, 6) * t) ** 2
+        samples[start:end] = 0.3 * voiced
+        position += burst + pause
+    samples += noise.normal(0, 0.001, len(samples)).astype(np.float32)
+    return (np.clip(samples, -1, 1) * 32767).astype(np.int16)
+
+
+def encode(samples):
+    import pydub
+
+    audio = pydub.AudioSegment(
+        samples.tobytes(), sample_width=2, frame_rate=args.sample_rate, channels=1
+    )
+    f = io.BytesIO()
+    audio.export(f, format=args.format)
+    return f.getvalue()
+
+
+def run_job(client, data):
+    """Submit one file and wait for its result, return the latency."""
+    start = time.perf_counter()
+    response = client.post(
+        "/audio/asr/fi/submit_file" + ("?nosplit=true" if args.nosplit else ""),
+        data={"file": (io.BytesIO(data), "bench." + args.format)},
+        content_type="multipart/form-data",
+    ).get_json()
+    if "jobid" not in response:
+        raise RuntimeError(response)
+    while True:
+        result = client.post(
+            "/audio/asr/fi/query_job?wait=60", data=response["jobid"]
+        ).get_json()
+        if result.get("status") == "done":
+            return time.perf_counter() - start
+        if "error" in result:
+            raise RuntimeError(result)
+
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="bench_asr_")
+    server = load_server(workdir)
+    client = server.app.test_client()
+    rng = random.Random(args.seed)
+    results = []
+    for kind in args.kinds.split(","):
+        for duration in [float(d) for d in args.durations.split(",")]:
+            data = encode(synthetic_audio(kind, duration, rng))
+            stages.reset()
+            latencies = []
+            errors = 0
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                futures = [
+                    executor.submit(run_job, client, data) for i in range(args.repeats)
+                ]
+                for future in futures:
+                    try:
+                        latencies.append(future.result())
+                    except Exception as ex:
+                        print(f"job failed: {ex}", file=sys.stderr)
+                        errors += 1
+            wall_time = time.perf_counter() - start
+            results.append(
+                {
+                    "kind": kind,
+                    "duration": duration,
+                    "jobs": len(latencies),
+                    "errors": errors,
+                    "wall_time": round(wall_time, 3),
+                    "throughput": round(duration * len(latencies) / wall_time, 3),
+                    "latency": percentiles(latencies),
+                    # peak of the whole process so far
+                    "peak_rss_mb": peak_rss_mb(),
+                    "stages": stages.summary(),
+                }
+            )
+            print(
+                f"{kind} {duration:g}s: {results[-1]['throughput']} audio s/s",
+                file=sys.stderr,
+            )
+    report = {
+        "config": {
+            key: value for key, value in vars(args).items() if key != "output"
+        },
+        "python": platform.python_version(),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Check that /utils/conllu2svg splits conllu2svg's output into the right trees.
+
+Imports the texttools package from services/web with redis replaced by
+fakeredis, so it needs the web service's python dependencies and conllu2svg
+from conllu-viewer, but no redis. Renders the sentences of a CoNLL-U file in
+one run as the endpoint does, and fails unless that gives one tree per
+sentence, each the same as when the sentence is rendered on its own, and
+nothing else in the output looks like part of a tree. Eg. in the web
+container
+
+    python conllu2svg_check.py --web-dir /usr/src/app
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+
+import fake_texttools
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description = 'Check splitting conllu2svg output into trees')
+parser.add_argument('--web-dir', default = os.path.join(test_dir, '..', 'services', 'web'))
+parser.add_argument('--conllu-file', default = os.path.join(test_dir, 'sample.conllu'))
+args = parser.parse_args()
+
+texttools = fake_texttools.import_texttools(args.web_dir, 'conllu2svg_check')
+
+with open(args.conllu_file, encoding = 'utf-8') as f:
+    blocks = texttools.conllu_blocks(f.read())
+
+together = texttools.render_svgs(blocks)
+alone = [texttools.render_svgs([block])[0] for block in blocks]
+html = texttools.conllu2html_text(texttools.tokenized_text(blocks), {})
+rest = html
+for svg in together:
+    rest = rest.replace(svg, '', 1)
+
+problems = []
+if len(together) != len(blocks):
+    problems.append('{} trees for {} sentences'.format(len(together), len(blocks)))
+problems.extend('sentence {} rendered differently alone'.format(i)
+                for i, (a, b) in enumerate(zip(together, alone)) if a != b)
+if re.search(r'</?svg\b', rest):
+    problems.append('svg tags left outside the trees')
+print(json.dumps({
+    'sentences': len(blocks),
+    'trees': len(together),
+    'tree_lengths': [len(svg) for svg in together],
+    'problems': problems,
+}, indent = 4))
+if problems:
+    sys.exit('conllu2svg output was not split into the trees of the sentences')
@@ -0,0 +1,30 @@
+"""Import the texttools package of the web service without redis, for the
+check scripts in this directory. They need the web service's python
+dependencies and fakeredis, and this file next to them."""
+
+import os
+import sys
+import tempfile
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+def import_texttools(web_dir, name):
+    """Import texttools from web_dir with redis replaced by fakeredis and
+    return it. Payloads go to a new temporary directory named after the check
+    unless PAYLOAD_DIR is set."""
+    os.environ.setdefault('PAYLOAD_DIR', tempfile.mkdtemp(prefix = name + '_'))
+
+    import redis
+    import fakeredis
+
+    class Redis(fakeredis.FakeRedis):
+        """Every connection gets the empty redis of its own that fakeredis gives."""
+        def __init__(self, host = None, port = None, **kw):
+            super().__init__(**kw)
+
+    redis.Redis = Redis
+    sys.path.insert(0, os.path.abspath(web_dir))
+    # servicecommon, which the image has in web_dir
+    sys.path.insert(1, os.path.join(test_dir, '..', 'services', 'common'))
+    import texttools
+    return texttools
@@ -0,0 +1,256 @@
+"""Load test: replay a mix of ASR, align and text submissions at a target rate.
+
+Like test_asr.py, test_align.py and test_texttools.py, but many jobs at once.
+Jobs are started on schedule whether or not earlier ones have finished, and
+their latency is counted from when they were scheduled, so a backed-up client
+doesn't hide a slow service. To run against the stack offline, start it with
+
+    docker-compose -f docker-compose.yml -f docker-compose.stubs.yml up
+
+and eg.
+
+    python loadtest.py --local --rate 2 --duration 120 --mix asr=1,align=1,postag=2,sentiment=2
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+LOAD_ERROR = "service unavailable due to load, try again later"
+
+parser = argparse.ArgumentParser(description="Load test the services")
+parser.add_argument("--local", action="store_true")
+parser.add_argument("--url", help="base url, overrides --local")
+parser.add_argument("--rate", type=float, default=1.0, help="jobs per second")
+parser.add_argument("--duration", type=float, default=60.0, help="seconds")
+parser.add_argument(
+    "--poisson", action="store_true", help="exponential rather than even intervals"
+)
+parser.add_argument(
+    "--mix",
+    default="asr=1,align=1,postag=1,nertag=1,sentiment=1",
+    help="relative weights of asr, align, the text tools and conllu2svg",
+)
+parser.add_argument("--asr-file", default="puhetta.mp3")
+parser.add_argument("--audio-file", default="pohjantuuli_F1_1_22050.wav")
+parser.add_argument("--text-file", default="pohjantuuli_F1_1_22050.txt")
+parser.add_argument("--input-text", help="text for the text tools, a file")
+parser.add_argument(
+    "--conllu-file", default="sample.conllu", help="CoNLL-U input for conllu2svg"
+)
+parser.add_argument("--wait", type=int, default=30)
+parser.add_argument(
+    "--poll-interval",
+    type=float,
+    default=1.0,
+    help="least seconds between queries of a pending job",
+)
+parser.add_argument(
+    "--timeout", type=float, default=600.0, help="give up on a job after this long"
+)
+parser.add_argument("--max-in-flight", type=int, default=256)
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--output", help="write the json here as well as to stdout")
+args = parser.parse_args()
+
+url = "http://kielipankki.rahtiapp.fi"
+if args.local:
+    url = "http://localhost:1337"
+if args.url:
+    url = args.url.rstrip("/")
+
+instring = """
+Keravan Teboililla kävi kuhina, kun ei voi voita voittaa mikään."
+"""
+if args.input_text:
+    instring = open(args.input_text, encoding="utf-8").read()
+
+TEXT_PATHS = {
+    "postag": "/text/fi/postag",
+    "nertag": "/text/fi/nertag",
+    "sentiment": "/text/fi/sentiment",
+    "annotate": "/text/fi/annotate",
+}
+
+
+class JobFailed(Exception):
+    pass
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def submit_asr():
+    response = requests.post(
+        url + "/audio/asr/fi/submit_file",
+        files={"file": (os.path.basename(args.asr_file), asr_bytes)},
+    )
+    return response, url + "/audio/asr/fi/query_job"
+
+
+def submit_align():
+    response = requests.post(
+        url + "/audio/align/fi/submit_file",
+        files={
+            "audio": (os.path.basename(args.audio_file), align_audio_bytes),
+            "transcript": (os.path.basename(args.text_file), align_text_bytes),
+        },
+    )
+    return response, url + "/audio/align/fi/query_job"
+
+
+def text_submitter(path):
+    def submit_text():
+        response = requests.post(url + path + "/submit", data=instring.encode("utf-8"))
+        return response, url + path + "/query_job"
+
+    return submit_text
+
+
+def submit_conllu2svg():
+    response = requests.post(url + "/utils/conllu2svg/submit", data=conllu_bytes)
+    return response, url + "/utils/conllu2svg/query_job"
+
+
+def parse(response):
+    try:
+        return json.loads(response.text)
+    except ValueError:
+        raise JobFailed(f"HTTP {response.status_code}")
+
+
+def pending(response_d):
+    return response_d.get("status") == "pending" or response_d.get("done") is False
+
+
+def run_job(endpoint, submit, scheduled):
+    """Submit and query one job, and record how it went."""
+    submitted = None
+    try:
+        response, query_url = submit()
+        submitted = time.time()
+        response_d = parse(response)
+        if "jobid" not in response_d:
+            raise JobFailed(response_d.get("error", "no jobid"))
+        while True:
+            if time.time() - scheduled > args.timeout:
+                raise JobFailed("timeout")
+            queried = time.time()
+            query_response_d = parse(
+                requests.post(query_url + f"?wait={args.wait}", data=response_d["jobid"])
+            )
+            if pending(query_response_d):
+                # the server answers at once if too many queries are waiting
+                time.sleep(max(0.0, args.poll_interval - (time.time() - queried)))
+                continue
+            if "error" in query_response_d:
+                error = query_response_d["error"]
+                raise JobFailed(error.get("message") if isinstance(error, dict) else error)
+            break
+        stats.record(endpoint, scheduled, submitted, time.time(), None)
+    except (JobFailed, requests.RequestException) as ex:
+        stats.record(endpoint, scheduled, submitted, time.time(), str(ex))
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def record(self, endpoint, scheduled, submitted, finished, error):
+        with self.lock:
+            self.jobs.setdefault(endpoint, []).append(
+                (scheduled, submitted, finished, error)
+            )
+
+    def report(self, wall_time):
+        with self.lock:
+            endpoints = {
+                endpoint: summarize(jobs, wall_time)
+                for endpoint, jobs in sorted(self.jobs.items())
+            }
+            all_jobs = [job for jobs in self.jobs.values() for job in jobs]
+        return {"total": summarize(all_jobs, wall_time), "endpoints": endpoints}
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        p: round(values[min(int(q * len(values)), len(values) - 1)], 3)
+        for p, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+    }
+
+
+def summarize(jobs, wall_time):
+    done = [job for job in jobs if job[3] is None]
+    errors = {}
+    for job in jobs:
+        if job[3] is not None:
+            errors[job[3]] = errors.get(job[3], 0) + 1
+    return {
+        "jobs": len(jobs),
+        "done": len(done),
+        "throughput": round(len(done) / wall_time, 3),
+        "error_rate": round(1 - len(done) / len(jobs), 3) if jobs else 0.0,
+        "load_shed": errors.get(LOAD_ERROR, 0),
+        "errors": errors,
+        # from when the job was due to be submitted
+        "latency": percentiles([finished - scheduled for scheduled, _, finished, _ in done]),
+        "submit_latency": percentiles(
+            [submitted - scheduled for scheduled, submitted, _, _ in jobs if submitted]
+        ),
+    }
+
+
+stats = Stats()
+
+submitters = {"asr": submit_asr, "align": submit_align, "conllu2svg": submit_conllu2svg}
+submitters.update({tool: text_submitter(path) for tool, path in TEXT_PATHS.items()})
+weights = {}
+for entry in args.mix.split(","):
+    endpoint, weight = entry.split("=")
+    if endpoint not in submitters:
+        sys.exit(f"unknown endpoint {endpoint}, expected one of {', '.join(submitters)}")
+    weights[endpoint] = float(weight)
+if "asr" in weights:
+    asr_bytes = read(args.asr_file)
+if "align" in weights:
+    align_audio_bytes = read(args.audio_file)
+    align_text_bytes = read(args.text_file)
+if "conllu2svg" in weights:
+    conllu_bytes = read(args.conllu_file)
+
+rng = random.Random(args.seed)
+executor = ThreadPoolExecutor(max_workers=args.max_in_flight)
+start = time.time()
+next_job = start
+while next_job < start + args.duration:
+    time.sleep(max(0.0, next_job - time.time()))
+    endpoint = rng.choices(list(weights), weights=list(weights.values()))[0]
+    executor.submit(run_job, endpoint, submitters[endpoint], next_job)
+    next_job += rng.expovariate(args.rate) if args.poisson else 1 / args.rate
+executor.shutdown(wait=True)
+wall_time = time.time() - start
+
+report = {
+    "config": {key: value for key, value in vars(args).items() if key != "output"},
+    "url": url,
+    "wall_time": round(wall_time, 3),
+}
+report.update(stats.report(wall_time))
+output = json.dumps(report, indent=2)
+print(output)
+if args.output:
+    with open(args.output, "w") as f:
+        f.write(output + "\n")
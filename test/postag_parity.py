@@ -0,0 +1,60 @@
+"""Check postag with POSTAG_IN_PROCESS against finnish-postag.
+
+Imports the texttools package from services/web with POSTAG_IN_PROCESS=true
+and redis replaced by fakeredis, so it needs the web service's python
+dependencies, finnish-tagtools, and OMORFI_TRANSDUCER and POSTAG_AFTER_LOOKUP
+set as for the service (see texttools/morphology.py; the web image sets
+them), but no redis. Tags a sample corpus through the postag endpoint's code
+and with finnish-postag itself, and fails if any sentence is tagged
+differently. Eg. in the web container
+
+    python postag_parity.py --web-dir /usr/src/app
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import fake_texttools
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description = 'Compare in-process postag with finnish-postag')
+parser.add_argument('--web-dir', default = os.path.join(test_dir, '..', 'services', 'web'))
+parser.add_argument('--text-file', default = os.path.join(test_dir, 'sentiment_sentences.txt'),
+                    help = 'sample corpus, one sentence per line')
+parser.add_argument('--show', type = int, default = 10, help = 'differing sentences to print')
+args = parser.parse_args()
+os.environ['POSTAG_IN_PROCESS'] = 'true'
+
+texttools = fake_texttools.import_texttools(args.web_dir, 'postag_parity')
+
+with open(args.text_file, encoding = 'utf-8') as f:
+    lines = [line.strip() for line in f if line.strip()]
+text = '\n\n'.join(' '.join(lines[i:i + 3]) for i in range(0, len(lines), 3))
+
+start = time.time()
+expected = texttools.parse_sentences(subprocess.run(
+    ["finnish-postag"], input = text, stdout = subprocess.PIPE, encoding = 'utf-8', check = True).stdout)
+expected_seconds = time.time() - start
+
+start = time.time()
+got = list(texttools.chain.from_iterable(texttools.postag_chunks(text, {})))
+got_seconds = time.time() - start
+
+differing = [(i, e, g) for i, (e, g) in enumerate(zip(expected, got)) if e != g]
+print(json.dumps({
+    'sentences': len(expected),
+    'in_process_sentences': len(got),
+    'differing': len(differing),
+    'finnish_postag_seconds': round(expected_seconds, 3),
+    'in_process_seconds': round(got_seconds, 3),
+}, indent = 4))
+for i, e, g in differing[:args.show]:
+    print('sentence {}\n  finnish-postag: {}\n  in process:     {}'.format(
+        i, json.dumps(e, ensure_ascii = False), json.dumps(g, ensure_ascii = False)))
+if len(expected) != len(got) or len(differing) > 0:
+    sys.exit('in-process postag differs from finnish-postag')
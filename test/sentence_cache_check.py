@@ -0,0 +1,70 @@
+"""Check that cached postag and sentiment results are the same as uncached ones.
+
+Imports the texttools package from services/web with redis replaced by
+fakeredis, so it needs the web service's python dependencies, finnish-tokenize
+and the s24_sentiment model files, but no redis. Runs the same text through
+postag_text and sentiment_text
+
+- with the sentence cache unavailable,
+- with an empty cache,
+- again with the cache warmed by that run, and
+- with the cache warmed by each sentence on its own,
+
+and fails if the results differ. Eg. in the web container
+
+    python sentence_cache_check.py --web-dir /usr/src/app
+"""
+
+import os
+import sys
+import json
+import argparse
+
+import fakeredis
+import fake_texttools
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description = 'Compare cached and uncached sentiment results')
+parser.add_argument('--web-dir', default = os.path.join(test_dir, '..', 'services', 'web'))
+parser.add_argument('--text-file', default = os.path.join(test_dir, 'sentiment_sentences.txt'),
+                    help = 'one sentence per line')
+args = parser.parse_args()
+
+texttools = fake_texttools.import_texttools(args.web_dir, 'sentence_cache_check')
+from texttools.cache import SentenceCache
+
+with open(args.text_file, encoding = 'utf-8') as f:
+    lines = [line.strip() for line in f if line.strip()]
+# paragraphs of a few sentences, so that sentences share batches with
+# different neighbours than when they are on their own
+text = '\n\n'.join(' '.join(lines[i:i + 3]) for i in range(0, len(lines), 3))
+
+def run(cache, text):
+    texttools.sentence_cache = cache
+    return json.loads(json.dumps({'postag': texttools.postag_text(text, {}),
+                                  'sentiment': texttools.sentiment_text(text, {})}))
+
+def new_cache():
+    return SentenceCache(fakeredis.FakeRedis())
+
+unavailable_server = fakeredis.FakeServer()
+unavailable_server.connected = False
+uncached = run(SentenceCache(fakeredis.FakeRedis(server = unavailable_server)), text)
+
+cache = new_cache()
+results = {'cold': run(cache, text), 'warm': run(cache, text)}
+
+cache = new_cache()
+for line in lines:
+    run(cache, line)
+results['warmed by sentences'] = run(cache, text)
+
+differing = [name for name, result in results.items() if result != uncached]
+print(json.dumps({
+    'sentences': len(uncached['sentiment']['sentiment']) - 1,
+    'document': uncached['sentiment']['sentiment'][-1][1],
+    'differing': differing,
+}, indent = 4, ensure_ascii = False))
+if differing:
+    sys.exit('cached results differ from uncached ones')
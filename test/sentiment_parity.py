@@ -0,0 +1,86 @@
+"""Check the int8 sentiment model against the fp32 final_model.pt.
+
+Loads services/web/texttools/cnn_sentiment.py directly, without the rest of
+the texttools service, so it needs torch, numpy and the s24_sentiment model
+files but no redis or tagtools. Classifies a held-out set of tokenized
+sentences, one per line, with both models, and fails if their labels agree
+less often than --min-agreement or their logits differ by more than
+--max-logit-diff. Also checks that each model gives a sentence the same
+features alone, in its length bucket and in one batch of all the sentences.
+Eg. in the web container
+
+    python sentiment_parity.py --texttools-dir /usr/src/app/texttools
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import argparse
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description = 'Compare the quantized and fp32 sentiment models')
+parser.add_argument('--texttools-dir', default = os.path.join(test_dir, '..', 'services', 'web', 'texttools'))
+parser.add_argument('--sentences', default = os.path.join(test_dir, 'sentiment_sentences.txt'))
+parser.add_argument('--min-agreement', type = float, default = 0.98)
+parser.add_argument('--max-logit-diff', type = float, default = 0.25)
+parser.add_argument('--repeats', type = int, default = 20, help = 'for timing')
+args = parser.parse_args()
+
+# the module, without importing the package's __init__
+package = types.ModuleType('texttools')
+package.__path__ = [os.path.abspath(args.texttools_dir)]
+sys.modules['texttools'] = package
+from texttools import cnn_sentiment
+
+import torch
+
+with open(args.sentences, encoding = 'utf-8') as f:
+    sentences = [line.split() for line in f if line.strip()]
+
+def run(model):
+    with cnn_sentiment.inference_mode():
+        features = model.batched_features(sentences)
+        logits = model.classify(features)
+        document = model.classify(features.max(dim = 0)[0].unsqueeze(0))
+    start = time.time()
+    for i in range(args.repeats):
+        model.sentence_features(sentences)
+    seconds = (time.time() - start) / args.repeats
+    return logits, model.labels(logits), model.labels(document)[0], seconds
+
+def batching_diff(model):
+    """Return the largest difference in a sentence's features between
+    computing it alone, bucketed and in one batch."""
+    with cnn_sentiment.inference_mode():
+        alone = torch.cat([model.features([sentence]) for sentence in sentences])
+        bucketed = model.batched_features(sentences)
+        one_batch = model.features(sentences)
+    return max((alone - bucketed).abs().max().item(), (alone - one_batch).abs().max().item())
+
+fp32 = cnn_sentiment.load(cnn_sentiment.s24_args)
+int8 = cnn_sentiment.load(cnn_sentiment.s24_args, quantized = True)
+fp32_logits, fp32_labels, fp32_document, fp32_seconds = run(fp32)
+int8_logits, int8_labels, int8_document, int8_seconds = run(int8)
+batching = {'fp32': batching_diff(fp32), 'int8': batching_diff(int8)}
+
+agreement = sum(a == b for a, b in zip(fp32_labels, int8_labels)) / len(sentences)
+max_logit_diff = (fp32_logits - int8_logits).abs().max().item()
+print(json.dumps({
+    'sentences': len(sentences),
+    'threads': torch.get_num_threads(),
+    'agreement': round(agreement, 4),
+    'max_logit_diff': round(max_logit_diff, 4),
+    'document': {'fp32': fp32_document, 'int8': int8_document},
+    'max_batching_diff': {name: round(diff, 6) for name, diff in batching.items()},
+    'disagreements': [{'sentence': ' '.join(sentence), 'fp32': a, 'int8': b}
+                      for sentence, a, b in zip(sentences, fp32_labels, int8_labels) if a != b],
+    'seconds_per_run': {'fp32': round(fp32_seconds, 4), 'int8': round(int8_seconds, 4)},
+}, indent = 4, ensure_ascii = False))
+
+if agreement < args.min_agreement or max_logit_diff > args.max_logit_diff or fp32_document != int8_document:
+    sys.exit('quantized model differs from fp32')
+if max(batching.values()) > 1e-4:
+    sys.exit("a sentence's features depend on the batch")
@@ -0,0 +1,14 @@
+#!/bin/sh
+# Stand-in for the aligner, see docker-compose.stubs.yml. For each transcript
+# in the data directory (4th argument), waits ALIGN_STUB_SECONDS and writes a
+# ctm giving every word one second.
+
+in_dir="$4"
+out_dir="${ALIGN_STUB_OUT_DIR:-/opt/kaldi/egs/kohdistus}/stub"
+mkdir -p "$out_dir"
+for txt in "$in_dir"/*.txt; do
+    id=$(basename "$txt" .txt)
+    sleep "${ALIGN_STUB_SECONDS:-1}"
+    awk -v id="$id" '{ for (i = 1; i <= NF; i++) printf "%s 1 %d.00 1.00 %s\n", id, n++, $i }' \
+        "$txt" > "$out_dir/$id.ctm"
+done
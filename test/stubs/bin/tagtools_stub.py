@@ -0,0 +1,49 @@
+"""Stand-ins for the finnish-tagtools commands, see docker-compose.stubs.yml.
+
+finnish-tokenize splits at whitespace and ends sentences at . ! or ?, the
+taggers tag every token as a noun with no named entity. Each run takes
+TAGTOOLS_STUB_SECONDS, like the real tools' startup time."""
+
+import os
+import re
+import sys
+import time
+
+
+def tokenize(text):
+    sentences = []
+    sentence = []
+    for token in re.findall(r"\w+|[^\w\s]", text):
+        sentence.append(token)
+        if token in ".!?":
+            sentences.append(sentence)
+            sentence = []
+    if sentence:
+        sentences.append(sentence)
+    return sentences
+
+
+def read_tokenized(text):
+    return [block.split() for block in re.split(r"\n\s*\n", text) if block.strip()]
+
+
+def main(tool, args):
+    time.sleep(float(os.environ.get("TAGTOOLS_STUB_SECONDS", 0.05)))
+    text = sys.stdin.read()
+    if tool == "finnish-tokenize" or "--no-tokenize" not in args:
+        sentences = tokenize(text)
+    else:
+        sentences = read_tokenized(text)
+    for sentence in sentences:
+        for token in sentence:
+            if tool == "finnish-tokenize":
+                print(token)
+            elif tool == "finnish-postag":
+                print("\t".join([token, token.lower(), "[POS=NOUN]|[NUM=SG]|[CASE=NOM]"]))
+            else:
+                print(token + "\t")
+        print()
+
+
+if __name__ == "__main__":
+    main(os.path.basename(sys.argv[0]), sys.argv[1:])
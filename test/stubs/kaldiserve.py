@@ -0,0 +1,55 @@
+"""Stand-in for the kaldiserve module, for running kaldi-serve without Kaldi.
+
+Decoding takes KALDISERVE_STUB_RTF seconds per second of audio plus
+KALDISERVE_STUB_OVERHEAD seconds, and returns one word per second of audio."""
+
+import os
+import io
+import time
+import wave
+from contextlib import contextmanager
+
+RTF = float(os.environ.get("KALDISERVE_STUB_RTF", 0.1))
+OVERHEAD = float(os.environ.get("KALDISERVE_STUB_OVERHEAD", 0.01))
+
+
+class Word:
+    def __init__(self, word, start_time, end_time):
+        self.word = word
+        self.start_time = start_time
+        self.end_time = end_time
+
+
+class Alternative:
+    def __init__(self, duration):
+        self.words = [Word("sana", float(i), float(i) + 0.5) for i in range(int(duration))]
+        self.transcript = " ".join(word.word for word in self.words)
+        self.confidence = 0.9
+
+
+def parse_model_specs(path):
+    return [{"path": path}]
+
+
+class ChainModel:
+    def __init__(self, spec):
+        self.spec = spec
+
+
+class Decoder:
+    def __init__(self, model):
+        self.model = model
+        self.duration = 0.0
+
+    def decode_wav_audio(self, data):
+        with wave.open(io.BytesIO(data)) as wav:
+            self.duration = wav.getnframes() / wav.getframerate()
+        time.sleep(OVERHEAD + RTF * self.duration)
+
+    def get_decoded_results(self, n_best, word_level=False, bidi_streaming=False):
+        return [Alternative(self.duration) for i in range(n_best)]
+
+
+@contextmanager
+def start_decoding(decoder):
+    yield
@@ -9,13 +9,14 @@ parser = argparse.ArgumentParser(description = 'Test the forced align API')
 parser.add_argument('--audio-file', default='pohjantuuli_F1_1_22050.wav')
 parser.add_argument('--text-file', default='pohjantuuli_F1_1_22050.txt')
 parser.add_argument('--local', action='store_true')
+parser.add_argument('--wait', type=int, default=30)
 args = parser.parse_args()
 
 url = 'http://kielipankki.rahtiapp.fi/audio/align/fi'
 if args.local:
     url = 'http://localhost:1337/audio/align/fi'
 submit_file_url = url + "/submit_file"
-query_url = url + "/query_job"
+query_url = url + "/query_job?wait={}".format(args.wait)
 
 response = requests.post(submit_file_url,
                          files = {
@@ -24,12 +25,12 @@ response = requests.post(submit_file_url,
                              'transcript': (os.path.basename(args.text_file),
                                             open(args.text_file, 'rb'))})
 response_d = json.loads(response.text)
-time.sleep(1)
 while True:
     query_response = requests.post(query_url, data = response_d['jobid'])
     query_response_d = json.loads(query_response.text)
     if ('status' in query_response_d and query_response_d['status'] == 'pending') or\
        ('done' in query_response_d and query_response_d['done'] == False):
+        # the server answers at once if too many queries are waiting
         time.sleep(1)
         continue
     else:
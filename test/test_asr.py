@@ -8,6 +8,7 @@ parser = argparse.ArgumentParser(description="Test the asr API")
 parser.add_argument("--file", default="puhetta.mp3")
 parser.add_argument("--local", action="store_true")
 parser.add_argument("--query-path", default="")
+parser.add_argument("--wait", type=int, default=30)
 args = parser.parse_args()
 
 url = "http://kielipankki.rahtiapp.fi/audio/asr/fi"
@@ -15,20 +16,20 @@ if args.local:
     url = "http://localhost:1337/audio/asr/fi"
 filename = args.file
 submit_file_url = url + "/submit_file"
-query_url = url + "/query_job" + args.query_path
+query_url = url + "/query_job" + args.query_path + f"?wait={args.wait}"
 load_url = "http://kielipankki.rahtiapp.fi/audio/asr/queue"
 
 response = requests.post(
     submit_file_url, files={"file": (filename, open(filename, "rb"))}
 )
 response_d = json.loads(response.text)
-time.sleep(1)
 while True:
     query_response = requests.post(query_url, data=response_d["jobid"])
     query_response_d = json.loads(query_response.text)
     if ("status" in query_response_d and query_response_d["status"] == "pending") or (
         "done" in query_response_d and query_response_d["done"] == False
     ):
+        # the server answers at once if too many queries are waiting
         time.sleep(1)
         continue
     else:
@@ -7,6 +7,7 @@ import argparse
 parser = argparse.ArgumentParser(description = 'Test the texttools API')
 parser.add_argument('--local', action='store_true')
 parser.add_argument('--query-path', default='')
+parser.add_argument('--wait', type=int, default=30)
 args = parser.parse_args()
 
 url = 'http://kielipankki.rahtiapp.fi/text/fi'
@@ -23,11 +24,11 @@ Keravan Teboililla kävi kuhina, kun ei voi voita voittaa mikään."
 
 response = requests.post(ner_url + '/submit', data = instring.encode('utf-8'))
 response_d = json.loads(response.text)
-time.sleep(1)
 while True:
-    query_response = requests.post(ner_url + '/query_job', data = response_d['jobid'])
+    query_response = requests.post(ner_url + f'/query_job?wait={args.wait}', data = response_d['jobid'])
     query_response_d = json.loads(query_response.text)
     if ('status' in query_response_d and query_response_d['status'] == 'pending') or ('done' in query_response_d and query_response_d['done'] == False):
+        # the server answers at once if too many queries are waiting
         time.sleep(1)
         continue
     else: